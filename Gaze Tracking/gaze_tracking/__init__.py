@@ -1 +1,2 @@
-from .gaze_tracking import GazeTracking
\ No newline at end of file
+from .gaze_tracking import GazeTracking
+from .result import GazeResult
\ No newline at end of file
@@ -0,0 +1,187 @@
+"""
+Offline batch engine: runs GazeTracking over recorded videos or frame
+directories with a process pool and writes one row per frame to a
+columnar .npz file.
+
+    python -m gaze_tracking.batch session1.mp4 frames_dir/ -o results/ --workers 8
+"""
+from __future__ import division
+import argparse
+import multiprocessing
+import os
+import time
+import cv2
+import numpy as np
+from . import models
+from .gaze_tracking import GazeTracking
+from .result import RESULT_DTYPE
+
+IMAGE_EXTENSIONS = (".png", ".jpg", ".jpeg", ".bmp")
+
+COLUMNS = ("frame",) + RESULT_DTYPE.names
+
+
+class FrameSource(object):
+    """Random access to the frames of a video file or of a directory of images"""
+
+    def __init__(self, path):
+        self.path = path
+        if os.path.isdir(path):
+            self.images = sorted(os.path.join(path, name) for name in os.listdir(path)
+                                 if name.lower().endswith(IMAGE_EXTENSIONS))
+            self.length = len(self.images)
+        else:
+            self.images = None
+            capture = cv2.VideoCapture(path)
+            if not capture.isOpened():
+                raise IOError("cannot open video {}".format(path))
+            self.length = int(capture.get(cv2.CAP_PROP_FRAME_COUNT))
+            capture.release()
+
+    def frames(self, start, stop):
+        """Yields (index, frame) for the frames in [start, stop)
+
+        Arguments:
+            start (int): Index of the first frame
+            stop (int): Index after the last frame
+        """
+        if self.images is not None:
+            for index in range(start, stop):
+                yield index, cv2.imread(self.images[index])
+            return
+
+        capture = cv2.VideoCapture(self.path)
+        capture.set(cv2.CAP_PROP_POS_FRAMES, start)
+        if int(capture.get(cv2.CAP_PROP_POS_FRAMES)) != start:
+            # Seeking isn't exact with every codec, decode from the beginning instead
+            capture.release()
+            capture = cv2.VideoCapture(self.path)
+            for _ in range(start):
+                capture.grab()
+
+        for index in range(start, stop):
+            ok, frame = capture.read()
+            if not ok:
+                break
+            yield index, frame
+        capture.release()
+
+
+def analyze_frames(gaze, frames, length, offset):
+    """Refreshes the tracker with every frame and returns the result columns
+
+    Arguments:
+        gaze (GazeTracking): Tracker, its calibration is carried from frame to frame
+        frames: Iterable of (index, frame)
+        length (int): Number of frames expected
+        offset (int): Index of the first frame
+    """
+    results = np.zeros(length, RESULT_DTYPE)
+    count = 0
+    for index, frame in frames:
+        gaze.refresh(frame)
+        results[index - offset] = gaze.result.as_record()
+        count += 1
+
+    columns = {"frame": np.arange(offset, offset + count)}
+    columns.update((name, results[name][:count]) for name in RESULT_DTYPE.names)
+    return columns
+
+
+def calibrate(gaze, source):
+    """Runs the tracker from the first frame until the calibration is complete,
+    as a serial run would. Returns the columns of these frames.
+
+    Arguments:
+        gaze (GazeTracking): Fresh tracker
+        source (FrameSource): Frames to analyze
+    """
+    def frames():
+        for index, frame in source.frames(0, source.length):
+            yield index, frame
+            if gaze.calibration.is_complete():
+                break
+
+    return analyze_frames(gaze, frames(), source.length, 0)
+
+
+_worker_gaze = None
+
+
+def _init_worker():
+    """Creates the tracker of a worker process. Forked workers share the models
+    preloaded by the parent, spawned ones load them once here."""
+    global _worker_gaze
+    _worker_gaze = GazeTracking()
+
+
+def _run_chunk(task):
+    path, start, stop, calibration = task
+    _worker_gaze.calibration = calibration
+    source = FrameSource(path)
+    return analyze_frames(_worker_gaze, source.frames(start, stop), stop - start, start)
+
+
+def concatenate(parts):
+    """Concatenates column dicts in order"""
+    return {name: np.concatenate([part[name] for part in parts]) for name in COLUMNS}
+
+
+def run(path, workers=None, chunk_size=500):
+    """Analyzes every frame of a video or frame directory and returns the result columns.
+    The frames up to the end of the calibration run serially, the rest is split into
+    chunks that all start from that calibration, so the result matches a serial run.
+
+    Arguments:
+        path (str): Video file or directory of images
+        workers (int): Number of processes, all the cores by default. 1 runs serially.
+        chunk_size (int): Number of frames per task
+    """
+    source = FrameSource(path)
+    gaze = GazeTracking()
+    head = calibrate(gaze, source)
+    start = len(head["frame"])
+    if start == source.length or not gaze.calibration.is_complete():
+        return head
+
+    bounds = [(first, min(first + chunk_size, source.length)) for first in range(start, source.length, chunk_size)]
+    if workers == 1:
+        parts = []
+        for first, last in bounds:
+            parts.append(analyze_frames(gaze, source.frames(first, last), last - first, first))
+    else:
+        models.preload()
+        tasks = [(path, first, last, gaze.calibration) for first, last in bounds]
+        with multiprocessing.Pool(workers, initializer=_init_worker) as pool:
+            parts = pool.map(_run_chunk, tasks, chunksize=1)
+
+    return concatenate([head] + parts)
+
+
+def save(columns, output):
+    """Writes the result columns to a compressed .npz file, one array per column"""
+    np.savez_compressed(output, **columns)
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Run GazeTracking over recorded sessions")
+    parser.add_argument("inputs", nargs="+", help="video files or directories of frames")
+    parser.add_argument("-o", "--output", default=".", help="directory for the .npz results")
+    parser.add_argument("--workers", type=int, default=None, help="number of processes (default: all cores)")
+    parser.add_argument("--chunk-size", type=int, default=500, help="frames per task")
+    args = parser.parse_args(argv)
+
+    if not os.path.isdir(args.output):
+        os.makedirs(args.output)
+    for path in args.inputs:
+        start = time.perf_counter()
+        columns = run(path, args.workers, args.chunk_size)
+        elapsed = time.perf_counter() - start
+        name = os.path.splitext(os.path.basename(os.path.normpath(path)))[0] + ".npz"
+        save(columns, os.path.join(args.output, name))
+        print("{}: {} frames in {:.1f} s ({:.1f} fps)".format(path, len(columns["frame"]), elapsed,
+                                                           len(columns["frame"]) / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,515 @@
+"""
+Per-stage microbenchmarks of the gaze pipeline. Every stage runs on
+generated frames at 480p, 720p and 1080p, no camera or display is needed.
+
+    python -m gaze_tracking.benchmark -o after.json --compare before.json
+
+The face detector and landmark predictor stages are skipped when dlib or
+the trained model aren't available.
+
+    python -m gaze_tracking.benchmark --startup --instances 8
+
+measures instead the cold start to the first result and the resident
+memory with N GazeTracking instances sharing the models, and
+
+    python -m gaze_tracking.benchmark --pupils recorded_eye_patches/
+
+compares the time and agreement of the pupil detection methods on eye
+patches saved as images.
+
+    python -m gaze_tracking.benchmark --scales
+
+checks that the gaze ratios don't depend on the eye scale the
+ResolutionController picks, and fails when they drift apart.
+
+    python -m gaze_tracking.benchmark --gate
+
+sweeps the irises across the gaze limits and fails when the MotionGate
+delays a change of direction by more than one frame.
+"""
+from __future__ import division
+import argparse
+import collections
+import json
+import os
+import platform
+import sys
+import time
+import tracemalloc
+import cv2
+import numpy as np
+from .calibration import Calibration
+from .eye import Eye, blinking_ratios, landmarks_array
+from .pupil import Pupil
+
+RESOLUTIONS = collections.OrderedDict([("480p", (640, 480)), ("720p", (1280, 720)), ("1080p", (1920, 1080))])
+
+class SyntheticFace(object):
+    """Draws a face with two eyes on a frame and keeps the matching landmarks
+    of the eyes, so the eye stages can run without the landmark model."""
+
+    def __init__(self, width, height, seed=0, gaze=0.25):
+        """
+        Arguments:
+            width (int): Frame width
+            height (int): Frame height
+            seed (int): Seed of the background noise
+            gaze (float): Horizontal position of the irises, as a fraction of half the eye
+                width from its center, positive towards the right of the image
+        """
+        rng = np.random.RandomState(seed)
+        frame = rng.randint(90, 140, (height, width, 3)).astype(np.uint8)
+        center_x, center_y = width // 2, height // 2
+        face_width = width // 4
+        cv2.ellipse(frame, (center_x, center_y), (face_width // 2, int(face_width * 0.65)), 0, 0, 360,
+                    (150, 170, 200), -1)
+
+        self.landmarks = np.zeros((68, 2), np.int32)  #Only the eye points are drawn, the others stay at 0
+        eye_width = face_width // 5
+        for side, first in ((0, 36), (1, 42)):
+            eye_x = center_x + (-1 if side == 0 else 1) * face_width // 5
+            eye_y = center_y - face_width // 8
+            half_w, half_h = eye_width // 2, eye_width // 5
+            cv2.ellipse(frame, (eye_x, eye_y), (half_w, half_h), 0, 0, 360, (235, 235, 235), -1)
+            cv2.circle(frame, (eye_x + int(half_w * gaze), eye_y), half_h, (30, 30, 30), -1)
+            outline = [(-half_w, 0), (-half_w // 3, -half_h), (half_w // 3, -half_h),
+                       (half_w, 0), (half_w // 3, half_h), (-half_w // 3, half_h)]
+            for offset, (dx, dy) in enumerate(outline):
+                self.landmarks[first + offset] = (eye_x + dx, eye_y + dy)
+
+        self.frame = frame
+        self.gray = cv2.cvtColor(frame, cv2.COLOR_BGR2GRAY)
+        self.face_box = (center_x - face_width // 2, center_y - int(face_width * 0.65),
+                         center_x + face_width // 2, center_y + int(face_width * 0.65))
+
+
+def synthetic_tracker(landmarks, **options):
+    """Returns a GazeTracking that takes the given landmarks instead of running the
+    face detector and the landmark predictor, for the synthetic frames the dlib
+    models can't see a face in. Everything after the landmarks runs as usual.
+
+    Arguments:
+        landmarks (numpy.ndarray): (68, 2) landmarks of every frame, e.g. SyntheticFace.landmarks
+        options: Arguments of GazeTracking
+    """
+    from .gaze_tracking import GazeTracking
+
+    class SyntheticGazeTracking(GazeTracking):
+        def _find_landmarks(self, frame):
+            return landmarks
+
+    return SyntheticGazeTracking(**options)
+
+
+def measure(function, repeats, budget):
+    """Times a function and measures the memory it allocates.
+
+    Arguments:
+        function: Callable without arguments
+        repeats (int): Maximum number of timed runs
+        budget (float): Maximum time spent in the timed runs, in seconds
+
+    Returns:
+        A dict with the median and p99 latency in microseconds, the number of
+        runs and the peak memory allocated by one run in bytes
+    """
+    function()  # warm up caches and lazy allocations
+
+    tracemalloc.start()
+    function()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    times = []
+    deadline = time.perf_counter() + budget
+    while len(times) < repeats and (len(times) < 5 or time.perf_counter() < deadline):
+        start = time.perf_counter()
+        function()
+        times.append(time.perf_counter() - start)
+
+    times = np.array(times) * 1e6
+    return {
+        "median_us": float(np.median(times)),
+        "p99_us": float(np.percentile(times, 99)),
+        "runs": len(times),
+        "alloc_peak_bytes": int(peak),
+    }
+
+
+def stages(face, gaze=None):
+    """Returns the stages to benchmark on a synthetic face, by name
+
+    Arguments:
+        face (SyntheticFace): Input frame and landmarks
+        gaze (GazeTracking): Provides the face detector and landmark predictor, optional
+    """
+    calibration = Calibration()
+    eye = Eye.__new__(Eye)
+    eye._isolate(face.gray, face.landmarks, Eye.LEFT_EYE_POINTS)
+    eye_frame = eye.frame
+    threshold = Calibration.find_best_threshold(eye_frame)
+    iris_frame = Pupil.image_processing(eye_frame, threshold)
+    probe = Pupil.__new__(Pupil)
+    probe.threshold = threshold
+
+    result = collections.OrderedDict()
+    result["cvtColor"] = lambda: cv2.cvtColor(face.frame, cv2.COLOR_BGR2GRAY)
+    if gaze is not None:
+        import dlib
+        box = dlib.rectangle(*face.face_box)
+        result["face_detector"] = lambda: gaze._face_detector(face.gray)
+        result["shape_predictor"] = lambda: gaze._predictor(face.gray, box)
+        shape = gaze._predictor(face.gray, box)
+        result["landmarks_array"] = lambda: landmarks_array(shape)
+    result["eye_isolate"] = lambda: eye._isolate(face.gray, face.landmarks, Eye.LEFT_EYE_POINTS)
+    result["blinking_ratio"] = lambda: eye._blinking_ratio(face.landmarks, Eye.LEFT_EYE_POINTS)
+    faces = np.repeat(face.landmarks[np.newaxis], 8, axis=0)
+    result["blinking_ratios_8_faces"] = lambda: blinking_ratios(faces, Eye.LEFT_EYE_POINTS)
+    result["pupil_preprocess"] = lambda: Pupil.preprocess(eye_frame)
+    result["pupil_find_contours"] = lambda: cv2.findContours(iris_frame, cv2.RETR_TREE, cv2.CHAIN_APPROX_NONE)
+    result["pupil_detect_iris"] = lambda: probe.detect_iris(eye_frame)
+    result["pupil_detect_iris_components"] = lambda: probe.detect_iris_components(eye_frame)
+    result["calibration_sweep"] = lambda: Calibration.find_best_threshold(eye_frame)
+    result["eye_full"] = lambda: Eye(face.gray, face.landmarks, 0, calibration)
+    return result
+
+
+def synthetic_eye_patches(count=200, seed=0):
+    """Returns eye patches with a dark iris drawn at a known sub-pixel center,
+    and the list of these centers
+
+    Arguments:
+        count (int): Number of patches
+        seed (int): Seed of the random generator
+    """
+    rng = np.random.RandomState(seed)
+    patches, centers = [], []
+    for _ in range(count):
+        width, height = rng.randint(50, 71), rng.randint(24, 35)
+        patch = rng.randint(190, 230, (height, width)).astype(np.uint8)
+        center = (rng.uniform(18, width - 18), rng.uniform(height / 2 - 2, height / 2 + 2))
+        radius = rng.uniform(height / 5, height / 4)
+        cv2.circle(patch, (int(round(center[0] * 16)), int(round(center[1] * 16))), int(round(radius * 16)),
+                   40, -1, cv2.LINE_AA, shift=4)
+        patches.append(patch)
+        centers.append(center)
+    return patches, centers
+
+
+def compare_pupil_methods(patches, centers=None):
+    """Runs every pupil detection method on the eye patches and returns, for each
+    method, the median time per eye, how many pupils were located and the mean
+    error in pixels. The error is measured against the given centers, or against
+    the CONTOURS method when there are none.
+
+    Arguments:
+        patches (list): Grayscale eye patches
+        centers (list): Real (x, y) pupil centers of the patches, optional
+    """
+    thresholds = [Calibration.find_best_threshold(patch) for patch in patches]
+    found = {}
+    report = collections.OrderedDict()
+    for method in (Pupil.CONTOURS, Pupil.COMPONENTS):
+        times, positions = [], []
+        for patch, threshold in zip(patches, thresholds):
+            start = time.perf_counter()
+            pupil = Pupil(patch, threshold, method)
+            times.append(time.perf_counter() - start)
+            positions.append(None if pupil.x is None else (pupil.x, pupil.y))
+        found[method] = positions
+        report[method] = {"median_us": float(np.median(times) * 1e6),
+                          "located": sum(position is not None for position in positions)}
+
+    references = centers or found[Pupil.CONTOURS]
+    for method, positions in found.items():
+        errors = [np.hypot(position[0] - reference[0], position[1] - reference[1])
+                  for position, reference in zip(positions, references)
+                  if position is not None and reference is not None]
+        report[method]["mean_error_px"] = float(np.mean(errors)) if errors else None
+        report[method]["error_reference"] = "ground truth" if centers else Pupil.CONTOURS
+    return report
+
+
+def load_eye_patches(path):
+    """Loads the images of a directory as grayscale eye patches"""
+    names = sorted(name for name in os.listdir(path) if name.lower().endswith((".png", ".jpg", ".jpeg", ".bmp")))
+    return [cv2.imread(os.path.join(path, name), cv2.IMREAD_GRAYSCALE) for name in names]
+
+
+def eye_scale_ratios(scales=(1.0, 0.6, 0.3), resolution="1080p", pupil_method=Pupil.COMPONENTS, frames=30):
+    """Analyzes the synthetic face at each eye scale and returns the
+    (horizontal, vertical) ratios by scale. The landmarks come from the
+    synthetic face, the landmark model isn't needed.
+
+    Arguments:
+        scales (list): Eye scales to compare
+        resolution (str): Name from RESOLUTIONS
+        pupil_method (str): Method used to locate the pupils
+        frames (int): Frames analyzed at each scale, enough to complete the calibration
+    """
+    face = SyntheticFace(*RESOLUTIONS[resolution])
+    ratios = collections.OrderedDict()
+    for scale in scales:
+        gaze = synthetic_tracker(face.landmarks, eye_scale=scale, pupil_method=pupil_method)
+        for _ in range(frames):
+            gaze.refresh(face.frame)
+        ratios[scale] = (gaze.result.horizontal_ratio, gaze.result.vertical_ratio)
+    return ratios
+
+
+def gate_delays(resolution="720p", contrast=1.0, step=0.02, repeats=3, calibration_frames=30):
+    """Moves the irises of the synthetic face from the right to the left and back,
+    and analyzes every frame with and without the MotionGate. Returns the number
+    of frames whose direction, blinking or not, lagged behind the ungated analysis
+    by exactly one frame and by more than one frame, and the number of reused frames.
+
+    Arguments:
+        resolution (str): Name from RESOLUTIONS
+        contrast (float): Factor applied to the frames, below 1 to emulate a dim image
+        step (float): Move of the irises between two positions, as a fraction of half the eye width
+        repeats (int): Frames drawn at each position, the gate can only reuse repeated ones
+        calibration_frames (int): Frames analyzed before the sweep, to complete the calibration
+    """
+    width, height = RESOLUTIONS[resolution]
+    positions = np.arange(-0.6, 0.6 + step, step)
+    positions = np.concatenate([positions, positions[::-1]])
+    faces = [SyntheticFace(width, height, seed=index, gaze=position)
+             for index, position in enumerate(np.repeat(positions, repeats))]
+    frames = [cv2.convertScaleAbs(face.frame, alpha=contrast) for face in faces]
+
+    gated = synthetic_tracker(faces[0].landmarks, motion_gate=True)
+    ungated = synthetic_tracker(faces[0].landmarks)
+    for _ in range(calibration_frames):
+        gated.refresh(frames[0])
+        ungated.refresh(frames[0])
+
+    def state(result):
+        return result.direction, result.blinking
+
+    late, too_late = 0, 0
+    expected = []
+    for frame in frames:
+        gated.refresh(frame)
+        ungated.refresh(frame)
+        expected.append(state(ungated.result))
+        if state(gated.result) != expected[-1]:
+            if len(expected) > 1 and state(gated.result) == expected[-2]:
+                late += 1
+            else:
+                too_late += 1
+    return {"frames": len(faces), "reused_frames": gated.motion_gate.reused_frames,
+            "late_frames": late, "too_late_frames": too_late}
+
+
+def load_gaze():
+    """Returns a GazeTracking if dlib and the landmark model are available, else None"""
+    try:
+        from .gaze_tracking import GazeTracking
+        gaze = GazeTracking()
+        gaze.warmup()
+        return gaze
+    except (ImportError, RuntimeError, IOError) as error:
+        print("Skipping the face detector and predictor stages: {}".format(error), file=sys.stderr)
+        return None
+
+
+def run(resolutions=None, repeats=200, budget=2.0, with_model=True):
+    """Runs every stage at every resolution and returns the report
+
+    Arguments:
+        resolutions (list): Names from RESOLUTIONS, all of them by default
+        repeats (int): Maximum number of timed runs per stage
+        budget (float): Maximum time per stage, in seconds
+        with_model (bool): Also benchmarks the dlib stages when available
+    """
+    gaze = load_gaze() if with_model else None
+    results = collections.OrderedDict()
+    for name in resolutions or RESOLUTIONS:
+        width, height = RESOLUTIONS[name]
+        face = SyntheticFace(width, height)
+        for stage, function in stages(face, gaze).items():
+            results["{}/{}".format(name, stage)] = measure(function, repeats, budget)
+
+    patches, centers = synthetic_eye_patches()
+
+    return {
+        "meta": {
+            "time": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "python": platform.python_version(),
+            "opencv": cv2.__version__,
+            "numpy": np.__version__,
+            "machine": platform.machine(),
+            "processor": platform.processor(),
+            "threads": cv2.getNumThreads(),
+        },
+        "results": results,
+        "pupils": compare_pupil_methods(patches, centers),
+    }
+
+
+def measure_startup(instances=4, model_path=None):
+    """Measures the time from a cold start to the first result, then the
+    resident memory once N trackers analyzed a frame. Must run before anything
+    else loads the models in the process.
+
+    The detector finds no face in the synthetic frame, so the landmark model is
+    loaded and the predictor run on the face box explicitly (warmup()): the
+    cold start and the memory include it, like they do with a real face.
+
+    Arguments:
+        instances (int): Number of GazeTracking instances
+        model_path (str): Path of the landmark model
+    """
+    import dlib
+    from . import models
+    from .gaze_tracking import GazeTracking
+
+    rss_start = models.resident_memory()
+    face = SyntheticFace(1280, 720)
+    box = dlib.rectangle(*face.face_box)
+    start = time.perf_counter()
+    trackers = [GazeTracking(model_path=model_path)]
+    trackers[0].warmup()
+    trackers[0].refresh(face.frame)
+    trackers[0]._predictor(face.gray, box)
+    cold_start = time.perf_counter() - start
+    start = time.perf_counter()
+    trackers[0].refresh(face.frame)
+    trackers[0]._predictor(face.gray, box)
+    next_frame = time.perf_counter() - start
+
+    trackers += [GazeTracking(model_path=model_path) for _ in range(instances - 1)]
+    for tracker in trackers:
+        tracker.refresh(face.frame)
+        tracker._predictor(face.gray, box)
+    rss_end = models.resident_memory()
+
+    return {
+        "cold_start_s": cold_start,
+        "next_frame_s": next_frame,
+        "instances": instances,
+        "models_loaded": models.is_loaded(model_path),
+        "rss_bytes": rss_end,
+        "rss_growth_bytes": rss_end - rss_start if rss_start is not None else None,
+    }
+
+
+def compare(report, baseline, tolerance=0.2):
+    """Returns the stages whose median latency grew by more than the tolerance
+
+    Arguments:
+        report (dict): New report
+        baseline (dict): Report to compare against
+        tolerance (float): Allowed relative slowdown, 0.2 is 20%
+    """
+    regressions = []
+    for key, new in report["results"].items():
+        old = baseline["results"].get(key)
+        if old is None or old["median_us"] <= 0:
+            continue
+        change = new["median_us"] / old["median_us"] - 1
+        if change > tolerance:
+            regressions.append((key, old["median_us"], new["median_us"], change))
+    return regressions
+
+
+def print_report(report, baseline=None):
+    for method, values in report.get("pupils", {}).items():
+        print("pupil {:<12} {:>8.1f} us/eye, {} located, mean error {} px ({})".format(
+            method, values["median_us"], values["located"],
+            "n/a" if values["mean_error_px"] is None else "{:.2f}".format(values["mean_error_px"]),
+            values["error_reference"]))
+    print("{:<32} {:>12} {:>12} {:>12} {:>10}".format("stage", "median (us)", "p99 (us)", "alloc (B)", "change"))
+    for key, values in report["results"].items():
+        change = ""
+        if baseline is not None and key in baseline["results"] and baseline["results"][key]["median_us"] > 0:
+            change = "{:+.0%}".format(values["median_us"] / baseline["results"][key]["median_us"] - 1)
+        print("{:<32} {:>12.1f} {:>12.1f} {:>12d} {:>10}".format(key, values["median_us"], values["p99_us"],
+                                                                values["alloc_peak_bytes"], change))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Per-stage benchmarks of the gaze pipeline")
+    parser.add_argument("-o", "--output", help="write the results to this JSON file")
+    parser.add_argument("--compare", help="JSON results of a previous run to compare with")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="allowed slowdown before flagging (0.2 = 20%%)")
+    parser.add_argument("--resolutions", nargs="+", choices=list(RESOLUTIONS), help="resolutions to run")
+    parser.add_argument("--repeats", type=int, default=200, help="maximum timed runs per stage")
+    parser.add_argument("--budget", type=float, default=2.0, help="maximum seconds per stage")
+    parser.add_argument("--no-model", action="store_true", help="skip the dlib stages")
+    parser.add_argument("--startup", action="store_true", help="measure the cold start and memory instead")
+    parser.add_argument("--instances", type=int, default=4, help="number of trackers for --startup")
+    parser.add_argument("--pupils", help="compare the pupil methods on the eye patches of this directory instead")
+    parser.add_argument("--scales", action="store_true", help="check that the gaze ratios don't depend on the eye scale")
+    parser.add_argument("--max-ratio-drift", type=float, default=0.05, help="allowed spread of the ratios for --scales")
+    parser.add_argument("--gate", action="store_true", help="check that the motion gate never delays a gaze change")
+    args = parser.parse_args(argv)
+
+    if args.gate:
+        failed = False
+        for contrast in (1.0, 0.3):
+            delays = gate_delays(contrast=contrast)
+            print("contrast {:.1f}: {frames} frames, {reused_frames} reused, {late_frames} one frame late, "
+                  "{too_late_frames} more than one frame late".format(contrast, **delays))
+            failed = failed or delays["too_late_frames"] > 0
+        if failed:
+            print("FAIL the motion gate delayed a gaze change by more than one frame")
+            return 1
+        return 0
+
+    if args.scales:
+        drift = 0.0
+        for method in (Pupil.CONTOURS, Pupil.COMPONENTS):
+            ratios = eye_scale_ratios(pupil_method=method)
+            for scale, (horizontal, vertical) in ratios.items():
+                print("{:<12} eye scale {:.1f}: horizontal {:.3f} vertical {:.3f}".format(
+                    method, scale, horizontal, vertical))
+            for axis in (0, 1):
+                values = [ratio[axis] for ratio in ratios.values()]
+                drift = max(drift, max(values) - min(values))
+        if drift > args.max_ratio_drift:
+            print("FAIL ratios drift by {:.3f} across the eye scales".format(drift))
+            return 1
+        return 0
+
+    if args.pupils:
+        comparison = compare_pupil_methods(load_eye_patches(args.pupils))
+        print(json.dumps(comparison, indent=2))
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(comparison, file, indent=2)
+        return 0
+
+    if args.startup:
+        startup = measure_startup(args.instances)
+        print("cold start to first result: {:.3f} s (next frame: {:.3f} s)".format(
+            startup["cold_start_s"], startup["next_frame_s"]))
+        if startup["rss_bytes"] is not None:
+            print("RSS with {} instances: {:.1f} MB (+{:.1f} MB)".format(
+                startup["instances"], startup["rss_bytes"] / 2 ** 20, startup["rss_growth_bytes"] / 2 ** 20))
+        if args.output:
+            with open(args.output, "w") as file:
+                json.dump(startup, file, indent=2)
+        return 0
+
+    report = run(args.resolutions, args.repeats, args.budget, not args.no_model)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as file:
+            baseline = json.load(file)
+    print_report(report, baseline)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if baseline is not None:
+        regressions = compare(report, baseline, args.tolerance)
+        for key, old, new, change in regressions:
+            print("REGRESSION {}: {:.1f} us -> {:.1f} us ({:+.0%})".format(key, old, new, change))
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
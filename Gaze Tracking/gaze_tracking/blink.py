@@ -0,0 +1,89 @@
+from __future__ import division
+from collections import namedtuple
+from .result import GazeResult
+
+BlinkEvent = namedtuple("BlinkEvent", ["count", "timestamp", "long_closure"])
+
+
+class BlinkRecognizer(object):
+    """
+    Recognizes single, double and triple blinks from the blink ratio of
+    each frame and its timestamp. It never blocks: every call returns
+    immediately, and a gesture is reported on the first frame after the
+    user stopped blinking for gesture_gap seconds.
+    """
+
+    def __init__(self, threshold=GazeResult.BLINK_LIMIT, min_closed=0.04, max_closed=0.6,
+                 refractory=0.1, gesture_gap=0.5, max_count=3):
+        """
+        Arguments:
+            threshold (float): Blink ratio above which the eyes are closed
+            min_closed (float): Shorter closures are noise, in seconds
+            max_closed (float): Longer closures aren't blinks, they are reported
+                right away as a long closure
+            refractory (float): Time after a blink during which a new closure is
+                ignored, so one blink is never counted twice
+            gesture_gap (float): Time without a new blink that ends a gesture
+            max_count (int): Highest blink count reported
+        """
+        self.threshold = threshold
+        self.min_closed = min_closed
+        self.max_closed = max_closed
+        self.refractory = refractory
+        self.gesture_gap = gesture_gap
+        self.max_count = max_count
+
+        self.count = 0  #Blinks of the gesture being recognized
+        self._closed_since = None
+        self._last_blink = None
+        self._long_reported = False
+
+    @property
+    def pending(self):
+        """True while a gesture has started and isn't reported yet"""
+        return self.count > 0 or self._closed_since is not None
+
+    def reset(self):
+        self.count = 0
+        self._closed_since = None
+        self._last_blink = None
+        self._long_reported = False
+
+    def update(self, blink_ratio, timestamp):
+        """Feeds the blink ratio of a frame.
+
+        Arguments:
+            blink_ratio (float): Blink ratio of the frame, None when no face was found
+            timestamp (float): Capture time of the frame, in seconds
+
+        Returns:
+            A BlinkEvent when a gesture is recognized on this frame, else None
+        """
+        if blink_ratio is not None:
+            closed = blink_ratio > self.threshold
+            if closed and self._closed_since is None:
+                if self._last_blink is None or timestamp - self._last_blink >= self.refractory:
+                    self._closed_since = timestamp
+            elif not closed and self._closed_since is not None:
+                duration = timestamp - self._closed_since
+                self._closed_since = None
+                if self._long_reported:
+                    self._long_reported = False
+                elif duration >= self.min_closed:
+                    self.count = min(self.count + 1, self.max_count)
+                    self._last_blink = timestamp
+
+        if self._closed_since is not None:
+            if not self._long_reported and timestamp - self._closed_since > self.max_closed:
+                # Eyes kept shut: report it now instead of waiting for them to open
+                self._long_reported = True
+                self.count = 0
+                self._last_blink = None
+                return BlinkEvent(1, timestamp, True)
+            return None
+
+        if self.count and timestamp - self._last_blink >= self.gesture_gap:
+            event = BlinkEvent(self.count, timestamp, False)
+            self.count = 0
+            return event
+        return None
@@ -0,0 +1,238 @@
+"""
+Shared memory bus for the frames and results of the pipeline. The
+producer writes every analyzed frame with its GazeResult and command into
+a ring of slots in a multiprocessing.shared_memory block; other processes
+(a recorder, a debug UI, a logger) attach by name and read the slots as
+NumPy views, nothing is pickled or sent through a pipe.
+
+The producer never waits for the readers: a reader that is slower than the
+ring is long misses slots. Each slot has a sequence number, written last,
+so a reader can check that the slot it holds a view on wasn't overwritten
+(BusReader.valid) or ask for a copy that is checked for it.
+
+    python -m gaze_tracking.bus NAME     prints the results published on NAME
+"""
+from __future__ import division
+import sys
+import time
+from collections import namedtuple
+from multiprocessing import resource_tracker, shared_memory
+import numpy as np
+from .result import RESULT_DTYPE
+
+COMMANDS = ("", "STOP", "CENTER", "LEFT", "RIGHT")  #Position in the tuple is the code stored in the slots
+
+RECORD_DTYPE = np.dtype([("timestamp", np.float64), ("command", np.int8)] + RESULT_DTYPE.descr)
+
+BusItem = namedtuple("BusItem", ["seq", "timestamp", "command", "result", "frame"])
+
+_MAGIC = 0x47415a45   #"GAZE"
+_VERSION = 1
+_HEADER = 8   #int64: magic, version, slots, height, width, channels, latest seq, record size
+_LATEST = 6
+
+
+def _layout(slots, shape):
+    """Returns the offsets of the slot sequences, the records and the frames, and the total size"""
+    def align(offset):
+        return (offset + 63) // 64 * 64
+    sequences = _HEADER * 8
+    records = align(sequences + 8 * slots)
+    frames = align(records + RECORD_DTYPE.itemsize * slots)
+    return sequences, records, frames, frames + slots * int(np.prod(shape))
+
+
+def _views(buffer, slots, shape):
+    sequences, records, frames, _ = _layout(slots, shape)
+    return (np.ndarray((_HEADER,), np.int64, buffer),
+            np.ndarray((slots,), np.int64, buffer, sequences),
+            np.ndarray((slots,), RECORD_DTYPE, buffer, records),
+            np.ndarray((slots,) + tuple(shape), np.uint8, buffer, frames))
+
+
+class FrameBus(object):
+    """
+    Producer side of the bus. The shared memory is created on the first
+    publish(), when the frame size is known, unless a shape is given.
+    """
+
+    def __init__(self, name, slots=8, shape=None):
+        """
+        Arguments:
+            name (str): Name of the shared memory block the readers attach to
+            slots (int): Number of frames kept, the lag a reader can have without missing any
+            shape (tuple): (height, width, channels) of the frames, to create the block now
+        """
+        self.name = name
+        self.slots = slots
+        self.seq = 0
+        self._memory = None
+        if shape is not None:
+            self._create(shape)
+
+    def _create(self, shape):
+        shape = tuple(shape) + (1,) * (3 - len(shape))
+        size = _layout(self.slots, shape)[3]
+        self._memory = shared_memory.SharedMemory(name=self.name, create=True, size=size)
+        self.shape = shape
+        self._header, self._sequences, self._records, self._frames = _views(self._memory.buf, self.slots, shape)
+        self._sequences[:] = 0
+        self._header[:] = (_MAGIC, _VERSION, self.slots) + shape + (0, RECORD_DTYPE.itemsize)
+
+    def publish(self, frame, result, timestamp=None, command=""):
+        """Writes a frame and its result into the next slot, returns its sequence number
+
+        Arguments:
+            frame (numpy.ndarray): Frame, all frames of a bus have the same size
+            result (GazeResult): Result of the analysis of the frame
+            timestamp (float): Capture time (time.perf_counter()), now by default
+            command (str): Command decided for the frame
+        """
+        if self._memory is None:
+            self._create(frame.shape)
+        frame = frame.reshape(frame.shape[:2] + (-1,))
+        if frame.shape != self.shape:
+            raise ValueError("frame shape {} doesn't match the bus {}".format(frame.shape, self.shape))
+
+        seq = self.seq + 1
+        slot = seq % self.slots
+        self._sequences[slot] = -seq   #Being written: readers holding this slot see it changed
+        self._frames[slot] = frame
+        self._records[slot] = (time.perf_counter() if timestamp is None else timestamp,
+                               COMMANDS.index(command or "")) + result.as_record()
+        self._sequences[slot] = seq
+        self._header[_LATEST] = seq
+        self.seq = seq
+        return seq
+
+    def close(self, unlink=True):
+        """Releases the shared memory, and removes it unless unlink is false"""
+        if self._memory is None:
+            return
+        self._header = self._sequences = self._records = self._frames = None
+        self._memory.close()
+        if unlink:
+            self._memory.unlink()
+        self._memory = None
+
+
+class BusReader(object):
+    """
+    Consumer side of the bus, in any process. Items hold views on the
+    shared memory: they stay valid until the producer reuses their slot,
+    `slots - 1` publications later.
+    """
+
+    def __init__(self, name):
+        """
+        Arguments:
+            name (str): Name given to the FrameBus
+
+        Raises FileNotFoundError while the producer hasn't published its first frame.
+        """
+        self._memory = shared_memory.SharedMemory(name=name)
+        # The producer owns the block, the resource tracker of this process mustn't remove it at exit
+        resource_tracker.unregister(self._memory._name, "shared_memory")
+        header = np.ndarray((_HEADER,), np.int64, self._memory.buf)
+        if header[0] != _MAGIC or header[1] != _VERSION or header[7] != RECORD_DTYPE.itemsize:
+            self._memory.close()
+            raise ValueError("{} isn't a frame bus of this version".format(name))
+        self.slots = int(header[2])
+        self.shape = tuple(int(value) for value in header[3:6])
+        self._header, self._sequences, self._records, self._frames = _views(self._memory.buf, self.slots, self.shape)
+        self.seq = max(int(self._header[_LATEST]) - 1, 0)   #Last sequence number read, next() starts at the newest item
+        self.missed = 0  #Items overwritten before this reader got to them
+
+    def _item(self, seq, copy):
+        slot = seq % self.slots
+        if self._sequences[slot] != seq:
+            return None
+        frame = self._frames[slot]
+        record = self._records[slot]
+        if copy:
+            frame = frame.copy()
+            record = record.copy()
+            if self._sequences[slot] != seq:   #Overwritten while copying
+                return None
+        return BusItem(seq, float(record["timestamp"]), COMMANDS[record["command"]], record, frame)
+
+    def latest(self, copy=False):
+        """Returns the newest item, or None if nothing was published yet
+
+        Arguments:
+            copy (bool): Copies the frame and the result out of the shared memory
+        """
+        while True:
+            seq = int(self._header[_LATEST])
+            if seq == 0:
+                return None
+            item = self._item(seq, copy)
+            if item is not None:
+                self.seq = seq
+                return item
+
+    def next(self, timeout=None, copy=False):
+        """Returns the item after the last one read, waiting for it if needed.
+        When it was already overwritten, skips to the oldest item still in the ring.
+        Returns None on timeout.
+
+        Arguments:
+            timeout (float): Maximum time to wait, in seconds
+            copy (bool): Copies the frame and the result out of the shared memory
+        """
+        deadline = None if timeout is None else time.perf_counter() + timeout
+        while True:
+            latest = int(self._header[_LATEST])
+            if latest > self.seq:
+                seq = max(self.seq + 1, latest - self.slots + 2)   #The oldest slot may be in the middle of a write
+                item = self._item(seq, copy)
+                if item is not None:
+                    self.missed += seq - self.seq - 1
+                    self.seq = seq
+                    return item
+                self.missed += 1
+                self.seq = seq
+                continue
+            if deadline is not None and time.perf_counter() >= deadline:
+                return None
+            time.sleep(0.001)   #No cross-process wakeup: the producer never waits on a lock
+
+    def valid(self, item):
+        """Returns true if the views of the item weren't overwritten yet"""
+        return self._sequences[item.seq % self.slots] == item.seq
+
+    def close(self):
+        """Detaches from the shared memory, once no item of this reader is in use"""
+        self._header = self._sequences = self._records = self._frames = None
+        self._memory.close()
+
+
+def main(argv=None):
+    argv = sys.argv[1:] if argv is None else argv
+    if len(argv) != 1:
+        print("usage: python -m gaze_tracking.bus NAME")
+        return 2
+    reader = None
+    while reader is None:
+        try:
+            reader = BusReader(argv[0])
+        except (FileNotFoundError, ValueError):   #Not created, or not initialized yet
+            time.sleep(0.5)
+    try:
+        while True:
+            item = reader.next(timeout=1.0)
+            if item is None:
+                continue
+            result = item.result
+            print("{} {:.3f} {:<6} face={} pupils={} horizontal={:.2f} blink={:.2f} missed={}".format(
+                item.seq, item.timestamp, item.command, bool(result["face_found"]),
+                bool(result["pupils_located"]), result["horizontal_ratio"], result["blink_ratio"], reader.missed))
+    except KeyboardInterrupt:
+        pass
+    finally:
+        reader.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
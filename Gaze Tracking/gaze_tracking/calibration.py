@@ -1,5 +1,6 @@
 from __future__ import division
 import cv2
+import numpy as np
 from .pupil import Pupil
 
 class Calibration(object):   #accurately detect the pupil in an eye frame
@@ -8,10 +9,97 @@ class Calibration(object):   #accurately detect the pupil in an eye frame
     best binarization threshold value for the person and webcam.
     """
 
-    def __init__(self):
+    def __init__(self, threshold_step=5, window=20):
         self.nb_frames=20  #Specifies the required number of frames (20) to complete calibration.
+        self.threshold_step=threshold_step  #Spacing between the thresholds tried for each frame. The sweep costs the same for any step.
+        self.window=max(window, self.nb_frames)  #Only the most recent thresholds are averaged, see swap()
+        self._averages=None  #(left, right) thresholds in use once the calibration is complete
         self.thresholds_left=[]  #These lists store the binarization threshold values computed for the left and right eyes over multiple frames.
         self.thresholds_right=[]
+        self.verify_frames=0  #Frames per eye left to check loaded thresholds against, see load()
+        self.verify_tolerance=15
+        self.verified=None  #True or False once loaded thresholds were checked
+        self._checks=[[], []]
+
+    def load(self, thresholds_left, thresholds_right, verify_frames=5, tolerance=15):
+        """ Starts from thresholds found in a previous session, calibration is complete at once.
+        The next frames of each eye are checked against them: if the best threshold of most
+        of those frames is too far from the loaded one, the lighting changed and the
+        calibration starts over.
+
+        Arguments:
+            thresholds_left (list): Thresholds of the left eye
+            thresholds_right (list): Thresholds of the right eye
+            verify_frames (int): Number of frames of each eye to check, 0 to trust the thresholds
+            tolerance (int): Largest accepted difference between the best and the loaded threshold
+        """
+        self.thresholds_left=[int(value) for value in thresholds_left][-self.window:]
+        self.thresholds_right=[int(value) for value in thresholds_right][-self.window:]
+        self._update_averages()
+        self.verify_frames=verify_frames
+        self.verify_tolerance=tolerance
+        self.verified=None if verify_frames else True
+        self._checks=[[], []]
+
+    def reset(self):
+        """ Forgets the thresholds, the calibration starts over"""
+        self.thresholds_left=[]
+        self.thresholds_right=[]
+        self._averages=None
+        self.verify_frames=0
+        self._checks=[[], []]
+
+    def swap(self, thresholds_left, thresholds_right):
+        """ Adds thresholds computed elsewhere (e.g. by a Recalibrator thread) to the
+        rolling windows and switches to the new averages in one assignment, so a
+        frame never reads the left threshold of one calibration and the right of another.
+
+        Arguments:
+            thresholds_left (list): New thresholds of the left eye
+            thresholds_right (list): New thresholds of the right eye
+        """
+        left=(list(self.thresholds_left) + [int(value) for value in thresholds_left])[-self.window:]
+        right=(list(self.thresholds_right) + [int(value) for value in thresholds_right])[-self.window:]
+        averages=(int(sum(left) / len(left)), int(sum(right) / len(right)))
+        self.thresholds_left=left
+        self.thresholds_right=right
+        self._averages=averages
+
+    def _update_averages(self):
+        if self.is_complete():
+            self._averages=(int(sum(self.thresholds_left) / len(self.thresholds_left)),
+                            int(sum(self.thresholds_right) / len(self.thresholds_right)))
+        else:
+            self._averages=None
+
+    def is_verifying(self):
+        """ Returns true while loaded thresholds are being checked"""
+        return self.verify_frames > 0
+
+    def verify(self, eye_frame, side):
+        """ Checks the loaded thresholds against the given image, see load().
+
+        Arguments:
+            eye_frame(numpy.ndarray): Frame of the eye
+            side: Indicates whether it's the left eye (0) or the right eye (1)
+        """
+        checks=self._checks[side]
+        if len(checks) >= self.verify_frames:
+            return
+        try:
+            best=self.find_best_threshold(eye_frame, self.threshold_step)
+        except ZeroDivisionError:
+            return
+        checks.append(abs(best - self.threshold(side)) <= self.verify_tolerance)
+
+        if all(len(side_checks) >= self.verify_frames for side_checks in self._checks):
+            fits=sum(self._checks[0]) + sum(self._checks[1])
+            self.verified=fits * 2 > len(self._checks[0]) + len(self._checks[1])
+            if self.verified:
+                self.verify_frames=0
+                self._checks=[[], []]
+            else:
+                self.reset()
 
     def is_complete(self):    # Checks if calibration is complete, which happens when both eyes have enough threshold values (20 frames each).
         """ Returns true if the calibration is completed"""
@@ -23,6 +111,9 @@ class Calibration(object):   #accurately detect the pupil in an eye frame
         Arguments:
             side: Indicates whether it's the left eye(0) or the right eye(1)
         """
+        averages = self._averages
+        if averages is not None:
+            return averages[side]
         if side == 0:
             return int(sum(self.thresholds_left)/ len(self.thresholds_left))
         elif side == 1:
@@ -41,19 +132,38 @@ class Calibration(object):   #accurately detect the pupil in an eye frame
         return nb_blacks / nb_pixels   #The ratio of black pixels to total pixels, indicating the percentage of the frame covered by the iris.
 
     @staticmethod
-    def find_best_threshold(eye_frame):   #Determines the threshold that produces the most accurate iris size.
+    def iris_sizes(eye_frame, thresholds):
+        """ Returns the iris size obtained with each threshold, in a single pass.
+        The frame is filtered and eroded once, then the number of black pixels for
+        every threshold is read from the cumulative histogram of the cropped frame.
+        It gives the same values as calling iris_size on image_processing for each threshold.
+
+        Arguments:
+            eye_frame(numpy.ndarray): Frame of the eye to analyzed
+            thresholds(numpy.ndarray): Threshold values to try
+        """
+        frame = Pupil.preprocess(eye_frame)[5:-5, 5:-5]   #Same crop as iris_size, applied before binarization
+        nb_pixels = frame.shape[0] * frame.shape[1]
+        if nb_pixels == 0:
+            raise ZeroDivisionError("eye frame is too small to measure the iris")
+
+        #A pixel stays black after cv2.THRESH_BINARY when its value is <= threshold
+        counts = np.cumsum(np.bincount(frame.ravel(), minlength=256))
+        return counts[thresholds] / nb_pixels
+
+    @staticmethod
+    def find_best_threshold(eye_frame, step=5):   #Determines the threshold that produces the most accurate iris size.
         """ Calculate the optimal threshold to binarize the frame for the given eye.
         Argument:
             eye_frame(numpy.ndarray): Frame of the eye to analyzed
+            step(int): Spacing between the thresholds tried, from 5 to 95
         """
         average_iris_size=0.48   #Expected percentage of the eye covered by the iris.
-        trials ={}    #Dictionary to store threshold values as keys and iris sizes as values.
-
-        for threshold in range (5,100,5):  #Iterates over possible threshold values (5 to 95).
-            iris_frame = Pupil.image_processing(eye_frame, threshold) #Binarizes the eye frame using Pupil.image_processing at the current threshold
-            trials[threshold]= Calibration.iris_size(iris_frame) # Stores the iris size computed at this threshold.
+        thresholds = np.arange(5, 100, step)
+        sizes = Calibration.iris_sizes(eye_frame, thresholds)
 
-        best_threshold, iris_size = min(trials.items(), key=(lambda p: abs(p[1] - average_iris_size)))  #trials is a dictionary where each key is a threshold value (e.g., 5, 10, 15, etc.), and each corresponding value is the measured iris size when that threshold was applied.Calling trials.items() returns a list of key-value pairs (tuples) in the formmin() is a function that returns the smallest item in an iterable (in this case, the dictionary items).The key parameter in min() allows us to define a custom rule for determining the "smallest" item.p[1] accesses the iris_size in each tuple.This difference (abs(p[1] - average_iris_size)) is used as the "weight" for each item when min() evaluates it.
+        #np.argmin keeps the first (lowest) threshold on ties, like min() over the trials did
+        best_threshold = int(thresholds[np.argmin(np.abs(sizes - average_iris_size))])
         return best_threshold
 
     def evaluate(self, eye_frame, side):
@@ -63,12 +173,18 @@ class Calibration(object):   #accurately detect the pupil in an eye frame
             eye_frame(numpy.ndarray): Frame of the eye
             side: Indicates whether it's the left eye (0) or the right eye (1)
         """
-        threshold =self.find_best_threshold(eye_frame)
+        try:
+            threshold =self.find_best_threshold(eye_frame, self.threshold_step)
+        except ZeroDivisionError:   #Eye cut by the edge of the image, nothing left to measure: the sample is skipped
+            return
 
         if side==0:
             self.thresholds_left.append(threshold)    #self.thresholds_left is a list of threshold values that have been calculated for the left eye.
+            del self.thresholds_left[:-self.window]
         elif side==1:
             self.thresholds_right.append(threshold)
+            del self.thresholds_right[:-self.window]
+        self._update_averages()
 
         #The evaluate function improves calibration by calculating an optimal threshold for binarizing the eye frame and storing this threshold in either thresholds_left (for the left eye) or thresholds_right (for the right eye). As more frames are evaluated, these lists accumulate values, which will help average or determine a final threshold for each eye, aiding in consistent pupil detection.
 
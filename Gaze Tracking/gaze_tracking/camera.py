@@ -1,15 +1,259 @@
+"""
+Camera discovery. On Linux the devices are listed from /dev/video* and
+their sysfs metadata without opening any stream, then every candidate is
+probed in parallel, within one shared timeout, for the modes it supports.
+Results are cached for as long as the set of devices doesn't change.
+Elsewhere the devices can't be listed, so results are only kept for a few
+seconds, after which cameras plugged in or removed are seen.
+
+On Linux the modes are read from the driver (V4L2 format, frame size and
+frame interval enumeration), so they are the real ones. Elsewhere, or when
+the driver doesn't enumerate them, OpenCV can only request the sizes of
+COMMON_MODES and read back what the camera snapped to: those modes are
+guesses, and their fps is whatever the camera reports for the mode, the
+frame rates aren't enumerated.
+
+    python -m gaze_tracking.camera
+"""
+from __future__ import division
+import glob
+import os
+import re
+import struct
+import threading
+import time
+from collections import namedtuple
 import cv2
 
-def available_cameras():
+try:
+    import fcntl
+except ImportError:  #Not on Windows, the modes are probed through OpenCV there
+    fcntl = None
+
+Camera = namedtuple("Camera", ["index", "path", "name", "modes"])  #modes: list of (width, height, fps)
+
+COMMON_MODES = ((640, 480), (1280, 720), (1920, 1080))  #Sizes requested when the modes can't be enumerated
+
+
+def _iowr(number, size):
+    return (3 << 30) | (size << 16) | (ord("V") << 8) | number
+
+# V4L2 ioctls and structures, see linux/videodev2.h
+_FMTDESC = struct.Struct("=3I32s2I3I")        #index, type, flags, description, pixelformat, mbus_code, reserved
+_FRMSIZE = struct.Struct("=3I6I2I")           #index, pixel_format, type, discrete or stepwise size, reserved
+_FRMIVAL = struct.Struct("=5I6I2I")           #index, pixel_format, width, height, type, discrete or stepwise interval, reserved
+_VIDIOC_ENUM_FMT = _iowr(2, _FMTDESC.size)
+_VIDIOC_ENUM_FRAMESIZES = _iowr(74, _FRMSIZE.size)
+_VIDIOC_ENUM_FRAMEINTERVALS = _iowr(75, _FRMIVAL.size)
+_BUF_TYPE_VIDEO_CAPTURE = 1
+_TYPE_DISCRETE = 1
+
+_cache = {}
+_cache_lock = threading.Lock()
+
+
+def _read(path):
+    try:
+        with open(path) as file:
+            return file.read().strip()
+    except IOError:
+        return None
+
+
+def _linux_devices():
+    """Returns (index, path, name) of the video capture nodes, from sysfs only"""
+    devices = []
+    for path in glob.glob("/dev/video*"):
+        match = re.match(r"/dev/video(\d+)$", path)
+        if not match:
+            continue
+        index = int(match.group(1))
+        sysfs = "/sys/class/video4linux/video{}".format(index)
+        # UVC cameras also expose a metadata node, it has a non-zero index
+        if _read(os.path.join(sysfs, "index")) not in (None, "0"):
+            continue
+        devices.append((index, path, _read(os.path.join(sysfs, "name")) or path))
+    return sorted(devices)
+
+
+def _enumerate(fd, request, layout, values):
+    """Yields the unpacked results of a V4L2 enumeration ioctl, for index 0, 1, ... until the driver refuses"""
     index = 0
-    cameras = []
     while True:
-        cap = cv2.VideoCapture(index)
-        if not cap.isOpened():
-            break
-        cameras.append(index)
-        cap.release()
+        buffer = bytearray(layout.pack(index, *values))
+        try:
+            fcntl.ioctl(fd, request, buffer)
+        except OSError:
+            return
+        yield layout.unpack(buffer)
         index += 1
+
+
+def _v4l2_sizes(fd, pixel_format):
+    """Returns the (width, height) supported for a pixel format"""
+    sizes = []
+    for size in _enumerate(fd, _VIDIOC_ENUM_FRAMESIZES, _FRMSIZE, (pixel_format, 0) + (0,) * 8):
+        if size[2] == _TYPE_DISCRETE:
+            sizes.append((size[3], size[4]))
+            continue
+        # Stepwise or continuous, a single range: the common sizes in it, and the largest one
+        min_width, max_width, _, min_height, max_height, _ = size[3:9]
+        sizes += [(width, height) for width, height in COMMON_MODES
+                  if min_width <= width <= max_width and min_height <= height <= max_height]
+        sizes.append((max_width, max_height))
+        break
+    return sizes
+
+
+def _v4l2_rates(fd, pixel_format, width, height):
+    """Returns the frame rates supported for a pixel format and a size"""
+    rates = []
+    for interval in _enumerate(fd, _VIDIOC_ENUM_FRAMEINTERVALS, _FRMIVAL,
+                               (pixel_format, width, height, 0) + (0,) * 8):
+        numerator, denominator = interval[5], interval[6]  #Shortest interval for a stepwise range
+        if numerator:
+            rates.append(denominator / numerator)
+        if interval[4] != _TYPE_DISCRETE:
+            break
+    return rates
+
+
+def _v4l2_modes(path):
+    """Returns the (width, height, fps) the driver of a video device lists, for every
+    pixel format, or None when they can't be enumerated. No stream is started."""
+    if fcntl is None or path is None:
+        return None
+    try:
+        fd = os.open(path, os.O_RDWR | os.O_NONBLOCK)
+    except OSError:
+        return None
+    found = set()
+    try:
+        for description in _enumerate(fd, _VIDIOC_ENUM_FMT, _FMTDESC, (_BUF_TYPE_VIDEO_CAPTURE, 0, b"", 0, 0, 0, 0, 0)):
+            pixel_format = description[4]
+            for width, height in _v4l2_sizes(fd, pixel_format):
+                for fps in _v4l2_rates(fd, pixel_format, width, height) or [0.0]:
+                    found.add((width, height, fps))
+    finally:
+        os.close(fd)
+    return sorted(found) or None
+
+
+def _probe(index, modes):
+    """Opens a camera and returns the (width, height, fps) it accepts among the modes,
+    or None if it can't be opened. The camera snaps each request to a mode it has,
+    so this only finds the modes closest to the requested ones, with the fps it
+    reports for them."""
+    capture = cv2.VideoCapture(index)
+    if not capture.isOpened():
+        return None
+    found = []
+    try:
+        for width, height in modes:
+            capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+            # Cameras snap unsupported requests to the closest mode they have
+            mode = (int(capture.get(cv2.CAP_PROP_FRAME_WIDTH)), int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                    capture.get(cv2.CAP_PROP_FPS))
+            if mode not in found:
+                found.append(mode)
+    finally:
+        capture.release()
+    return sorted(found)
+
+
+def _probe_all(candidates, modes, timeout):
+    """Probes the (index, path) candidates in parallel and returns their modes by
+    index, and the indices that didn't answer before the timeout, which are left out.
+    The timeout is shared: the call returns at most `timeout` seconds after it starts."""
+    results = {}
+
+    def probe(index, path):
+        found = _v4l2_modes(path)
+        if found is None:
+            found = _probe(index, modes)
+        results[index] = found
+
+    threads = [(index, threading.Thread(target=probe, args=(index, path), daemon=True))
+               for index, path in candidates]
+    for _, thread in threads:
+        thread.start()
+    deadline = time.perf_counter() + timeout
+    for _, thread in threads:
+        thread.join(max(deadline - time.perf_counter(), 0))
+    timed_out = [index for index, thread in threads if thread.is_alive()]
+    found = {index: modes for index, modes in list(results.items()) if modes is not None and index not in timed_out}
+    return found, timed_out
+
+
+def available_cameras(probe=True, modes=COMMON_MODES, timeout=3.0, max_index=8, refresh=False, ttl=10.0):
+    """Returns the cameras that can be opened, with the modes they support.
+
+    Arguments:
+        probe (bool): Opens the cameras to read their modes. Without probing, the
+            Linux devices are listed from sysfs only and modes are empty.
+        modes (tuple): (width, height) requested to the cameras whose modes can't be enumerated
+        timeout (float): Maximum time to wait for all the cameras. The result isn't
+            cached when a camera didn't answer in time, it is probed again on the next call.
+        max_index (int): Indices tried where /dev/video* doesn't exist
+        refresh (bool): Ignores the cache
+        ttl (float): Seconds a result is cached where the devices can't be listed. The
+            cache key doesn't change there when a camera is plugged in or removed.
+    """
+    if os.path.isdir("/sys/class/video4linux") or glob.glob("/dev/video*"):
+        devices = _linux_devices()
+        ttl = None   #The key changes with the devices
+    else:
+        devices = [(index, None, "camera {}".format(index)) for index in range(max_index)]
+
+    key = (tuple(devices), probe, tuple(modes))
+    with _cache_lock:
+        if not refresh and key in _cache:
+            cameras, expires = _cache[key]
+            if expires is None or time.monotonic() < expires:
+                return cameras
+
+    timed_out = []
+    if probe:
+        found, timed_out = _probe_all([(index, path) for index, path, _ in devices], modes, timeout)
+        cameras = [Camera(index, path, name, found[index]) for index, path, name in devices if index in found]
+    else:
+        cameras = [Camera(index, path, name, []) for index, path, name in devices]
+
+    if not timed_out:   #A slow camera isn't remembered as absent
+        with _cache_lock:
+            _cache[key] = (cameras, None if ttl is None else time.monotonic() + ttl)
     return cameras
 
-print(available_cameras())
\ No newline at end of file
+
+def select_camera(cameras, preferred_index=None):
+    """Returns the preferred camera if it is available, else the first one, or None
+
+    Arguments:
+        cameras (list): Cameras from available_cameras()
+        preferred_index (int): Index to use when it is available
+    """
+    for camera in cameras:
+        if camera.index == preferred_index:
+            return camera
+    return cameras[0] if cameras else None
+
+
+def best_mode(camera, width=1280, height=720):
+    """Returns the (width, height, fps) of the camera closest to the requested size,
+    the fastest one among equally close modes. None if the camera has no known mode.
+
+    Arguments:
+        camera (Camera): Camera from available_cameras()
+        width (int): Requested width
+        height (int): Requested height
+    """
+    if not camera.modes:
+        return None
+    return min(camera.modes, key=lambda mode: (abs(mode[0] * mode[1] - width * height), -mode[2]))
+
+
+if __name__ == "__main__":
+    for camera in available_cameras():
+        print("{} {} ({}): {}".format(camera.index, camera.path, camera.name,
+                                      ", ".join("{}x{}@{:g}".format(*mode) for mode in camera.modes)))
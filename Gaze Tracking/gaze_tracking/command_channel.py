@@ -0,0 +1,258 @@
+"""
+Command channel to the Arduino. Commands are written by a background
+thread, only when they change, plus a periodic heartbeat that repeats the
+current command. STOP jumps ahead of anything still queued, and is written
+on its own when the producer stops calling send() for longer than the
+timeout, or when a write fails.
+
+Framed protocol (default), 4 bytes per command:
+
+    0xA5 | sequence number (0-255) | command byte | sequence ^ command byte
+
+with the command bytes S (STOP), C (CENTER), L (LEFT) and R (RIGHT).
+LineProtocol keeps the original "CENTER\\n" text lines for firmware that
+doesn't decode frames yet.
+
+Any object with a write(bytes) method can be the transport: a serial.Serial
+(also on a pty, for tests), or a MemoryTransport.
+"""
+from __future__ import division
+import logging
+import threading
+import time
+from collections import deque
+
+STOP = "STOP"
+COMMANDS = ("STOP", "CENTER", "LEFT", "RIGHT")
+
+logger = logging.getLogger(__name__)
+
+
+class FramedProtocol(object):
+    """Encodes each command as a 4 bytes frame with a sequence number"""
+
+    SYNC = 0xA5
+    CODES = {"STOP": b"S", "CENTER": b"C", "LEFT": b"L", "RIGHT": b"R"}
+    COMMANDS = {code[0]: command for command, code in CODES.items()}
+
+    def encode(self, command, seq):
+        code = self.CODES[command][0]
+        return bytes((self.SYNC, seq, code, seq ^ code))
+
+    def decode(self, data):
+        """Returns the (seq, command) of every valid frame in data, skipping garbage
+
+        Arguments:
+            data (bytes): Received bytes
+        """
+        frames = []
+        index = 0
+        while index + 4 <= len(data):
+            sync, seq, code, check = data[index:index + 4]
+            if sync == self.SYNC and check == seq ^ code and code in self.COMMANDS:
+                frames.append((seq, self.COMMANDS[code]))
+                index += 4
+            else:
+                index += 1
+        return frames
+
+
+class LineProtocol(object):
+    """Encodes each command as an ASCII line, like main.py always did"""
+
+    def encode(self, command, seq):
+        return (command + "\n").encode("ascii")
+
+    def decode(self, data):
+        return [(None, line) for line in data.decode("ascii").splitlines() if line]
+
+
+class MemoryTransport(object):
+    """In-memory fake serial port that records what was written and when"""
+
+    def __init__(self, delay_per_byte=0.0):
+        """
+        Arguments:
+            delay_per_byte (float): Time a write takes per byte, to emulate the wire
+                (about 0.00104 s at 9600 baud)
+        """
+        self.delay_per_byte = delay_per_byte
+        self.writes = []   #(time.perf_counter() after the write, bytes)
+        self._lock = threading.Lock()
+
+    def write(self, data):
+        if self.delay_per_byte:
+            time.sleep(self.delay_per_byte * len(data))
+        with self._lock:
+            self.writes.append((time.perf_counter(), bytes(data)))
+        return len(data)
+
+    def data(self):
+        with self._lock:
+            return b"".join(data for _, data in self.writes)
+
+    def arrivals(self, protocol):
+        """Returns (time, command) of every command written, decoded with the protocol
+
+        Arguments:
+            protocol: Protocol the commands were encoded with
+        """
+        with self._lock:
+            writes = list(self.writes)
+        return [(arrived, command) for arrived, data in writes for _, command in protocol.decode(data)]
+
+
+class CommandChannel(object):
+    """
+    Sends commands on a background thread. send() never blocks: a new
+    command replaces the one that is still waiting, and STOP is always
+    written first. The heartbeat only repeats a command while the producer
+    is alive: once send() wasn't called for `timeout` seconds, STOP is
+    written instead.
+    """
+
+    def __init__(self, transport, protocol=None, heartbeat=0.5, timeout=1.0):
+        """
+        Arguments:
+            transport: Object with a write(bytes) method, e.g. serial.Serial
+            protocol: FramedProtocol (default) or LineProtocol
+            heartbeat (float): Seconds after which the current command is sent again,
+                None to disable
+            timeout (float): Seconds without any send() after which STOP is written,
+                None to disable
+        """
+        self.transport = transport
+        self.protocol = protocol or FramedProtocol()
+        self.heartbeat = heartbeat
+        self.timeout = timeout
+
+        self.current = None  #Last command accepted by send()
+        self.seq = 0
+        self.frames_sent = 0
+        self.bytes_sent = 0
+        self.heartbeats = 0
+        self.replaced = 0  #Commands replaced before they were written
+        self.timeouts = 0  #STOPs written because the producer went quiet
+        self.errors = 0  #Failed writes
+        self.failure = None  #Exception of the last failed write
+
+        self._queue = deque()
+        self._cond = threading.Condition()
+        self._last_write = None
+        self._last_send = None
+        self._running = True
+        self._thread = threading.Thread(target=self._write_loop, daemon=True)
+        self._thread.start()
+
+    def send(self, command):
+        """Queues a command if it differs from the current one.
+
+        Arguments:
+            command (str): STOP, CENTER, LEFT or RIGHT
+
+        Returns:
+            True if the command was queued, False if it was already the current one
+
+        Raises ValueError for an unknown command.
+        """
+        if command not in COMMANDS:
+            raise ValueError("unknown command {!r}".format(command))
+        with self._cond:
+            self._last_send = time.perf_counter()   #Repeating the current command keeps it alive too
+            if command == self.current:
+                return False
+            self.current = command
+            if command == STOP:
+                self.replaced += len(self._queue)
+                self._queue.clear()
+                self._queue.appendleft(command)
+            else:
+                # Only the newest movement command matters, a queued STOP stays first
+                while self._queue and self._queue[-1] != STOP:
+                    self._queue.pop()
+                    self.replaced += 1
+                self._queue.append(command)
+            self._cond.notify()
+        return True
+
+    def close(self, stop=True, timeout=1.0):
+        """Stops the writer thread.
+
+        Arguments:
+            stop (bool): Writes STOP before closing, so the robot doesn't keep moving
+            timeout (float): Maximum time to wait for the writer
+        """
+        if stop:
+            self.send(STOP)
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+        self._thread.join(timeout)
+
+    def _write(self, command):
+        data = self.protocol.encode(command, self.seq)
+        self.transport.write(data)
+        self.seq = (self.seq + 1) % 256
+        self.frames_sent += 1
+        self.bytes_sent += len(data)
+        self._last_write = time.perf_counter()
+
+    def _write_safely(self, command):
+        """Writes a command, on failure logs it and tries to write STOP. Returns False on failure."""
+        try:
+            self._write(command)
+            return True
+        except Exception as error:
+            self.errors += 1
+            self.failure = error
+            logger.exception("Writing %s failed", command)
+        with self._cond:
+            # Whatever the producer sends next differs from STOP and is written again
+            self.current = STOP
+        if command != STOP:
+            try:
+                self._write(STOP)
+            except Exception:
+                logger.exception("Writing STOP failed")
+        return False
+
+    def _expired(self, now):
+        """Returns true when the producer went quiet while a movement command is current"""
+        return (self.timeout is not None and self._last_send is not None and self.current not in (None, STOP)
+                and now - self._last_send >= self.timeout)
+
+    def _write_loop(self):
+        while True:
+            with self._cond:
+                while self._running and not self._queue:
+                    now = time.perf_counter()
+                    if self._expired(now):
+                        break
+                    timeout = None
+                    if self.heartbeat is not None and self._last_write is not None:
+                        timeout = self._last_write + self.heartbeat - now
+                        if timeout <= 0:
+                            break
+                    if self.timeout is not None and self._last_send is not None and self.current not in (None, STOP):
+                        expiry = self._last_send + self.timeout - now
+                        timeout = expiry if timeout is None else min(timeout, expiry)
+                    self._cond.wait(timeout)
+                heartbeat = False
+                if self._queue:
+                    command = self._queue.popleft()
+                elif self._running and self._expired(time.perf_counter()):
+                    # No command for too long: the producer died or stalled, stop the robot
+                    command = self.current = STOP
+                    self.timeouts += 1
+                    logger.warning("No command for %.2f s, sending STOP", self.timeout)
+                elif self._running and self.current is not None:
+                    command = self.current
+                    heartbeat = True
+                else:
+                    if not self._running:
+                        return
+                    continue
+
+            # Written outside the lock, send() never waits for the wire
+            if self._write_safely(command) and heartbeat:
+                self.heartbeats += 1
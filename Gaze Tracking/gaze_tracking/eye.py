@@ -1,19 +1,56 @@
 import math
+import threading
 import numpy as np
 import cv2
 from .pupil import Pupil
 
+
+def landmarks_array(landmarks):
+    """ Returns the landmarks as a (68, 2) int32 array of (x, y), converting
+    a dlib.full_object_detection once instead of reading its points one by one.
+
+    Arguments:
+        landmarks: dlib.full_object_detection, or an array that is returned as is
+    """
+    if isinstance(landmarks, np.ndarray):
+        return landmarks
+    return np.array([(point.x, point.y) for point in landmarks.parts()], dtype=np.int32)
+
+
+def blinking_ratios(landmarks, points):
+    """ Returns the blinking ratio (width / height) of an eye for many faces at once.
+
+    Arguments:
+        landmarks (numpy.ndarray): (faces, 68, 2) landmarks
+        points (list): Points of an eye (from the 68 Multi-PIE landmarks)
+
+    Returns:
+        An array of ratios, NaN where the eye height is 0
+    """
+    region = landmarks[:, points, :].astype(np.float64)
+    # Middle of the top and bottom lids, truncated to whole pixels like the landmarks
+    top = np.trunc((region[:, 1] + region[:, 2]) / 2)
+    bottom = np.trunc((region[:, 5] + region[:, 4]) / 2)
+    width = np.sqrt(np.square(region[:, 0] - region[:, 3]).sum(axis=1))
+    height = np.sqrt(np.square(top - bottom).sum(axis=1))
+    return np.divide(width, height, out=np.full(len(region), np.nan), where=height > 0)
+
 class Eye(object): #This class is responsible for isolating an eye from the image, calculating whether the eye is open or closed, and detecting the pupil’s location.
     """ This class creates a new frame to isolate the eye and initiates the pupil detection."""
 
     LEFT_EYE_POINTS=[36,37,38,39,40,41]
     RIGHT_EYE_POINTS=[42,43,44,45,46,47]
+    MARGIN=5  #Pixels kept around the eye landmarks when the eye is cropped
+
+    _buffers = threading.local()  #Scratch mask reused by every Eye created in the same thread
 
-    def __init__(self, original_frame, landmarks, side, calibration):
+    def __init__(self, original_frame, landmarks, side, calibration, pupil_method=Pupil.CONTOURS):
         """original_frame: The frame containing the face.
-        landmarks: Facial landmark points for the face.
+        landmarks: Facial landmark points for the face, a (68, 2) array (see landmarks_array).
         side: Indicates whether it’s the left (0) or right (1) eye.
-        calibration: A Calibration object that manages threshold values for eye calibration"""
+        calibration: A Calibration object that manages threshold values for eye calibration
+        pupil_method: Method used by Pupil to locate the iris"""
+        self.pupil_method = pupil_method
         self.frame=None   #Stores the isolated eye frame.
         self.origin=None  #Stores the coordinates of the top-left corner of the isolated eye region
         self.center=None  #Stores the center point of the isolated eye frame.
@@ -22,50 +59,52 @@ class Eye(object): #This class is responsible for isolating an eye from the imag
 
         self._analyze(original_frame, landmarks, side, calibration)  # Initializes the eye by calling the _analyze method to isolate the eye and detect the pupil.
 
-    @staticmethod
-    def _middle_point(p1,p2):
-        """ Returns the middle point (x,y) between two pints
+    @classmethod
+    def _mask_buffer(cls, shape):
+        """ Returns a white mask of the given shape, taken from a buffer
+        that is only reallocated when a bigger eye shows up.
 
         Arguments:
-            p1 (dlib.point) : First point
-            p2 (dlib.point) : Second point
+            shape (tuple): Height and width of the mask
         """
-
-        x= int((p1.x + p2.x) / 2)   #Calculates the midpoint between two given points p1 and p2, often used to find the midpoint of the top and bottom of the eye to measure its height.
-        y= int((p1.y + p2.y) / 2)
-        return (x, y)
+        height, width = shape
+        buffer = getattr(cls._buffers, "mask", None)
+        if buffer is None or buffer.shape[0] < height or buffer.shape[1] < width:
+            buffer = np.empty((max(height, 64), max(width, 128)), np.uint8)
+            cls._buffers.mask = buffer
+        mask = buffer[:height, :width]
+        mask.fill(255)
+        return mask
 
     def _isolate(self, frame, landmarks, points):
         """ Isolate an eye, to have a frame without other part of the face.
 
         Arguments:
             frame(numpy.ndarray): Frame containing the face
-            landmarks (dlib.full_object_detection): Facial landmarks for the face region
+            landmarks (numpy.ndarray): (68, 2) facial landmarks for the face region
             points (list) : Points of an eye (from the 68 Multi-PIE landmarks)
+
+        Raises ValueError when the eye is cut by the edge of the frame and too little of it is left.
         """
-        #This part extracts the coordinates of the eye region based on landmark points. This data allows us to isolate the eye region precisely within the facial frame.
-        region=np.array([(landmarks.part(point).x, landmarks.part(point).y) for point in points]) #This part extracts the coordinates of the eye region based on landmark points. It forms an array region containing (x, y) coordinates for each eye landmark.
-        region=region.astype(np.int32) #astype(np.int32) ensures that the array uses integer data, which is needed for OpenCV functions.
+        #The coordinates of the eye region are taken from the landmarks array in one indexing operation.
+        region=landmarks[points].astype(np.int32) #astype(np.int32) ensures that the array uses integer data, which is needed for OpenCV functions.
         self.landmark_points=region #self.landmark_points stores these points, which can be used later for tracking or drawing.
 
-        # Applying a mask to get only the eye
-        height, width = frame.shape[:2] # This line retrieves the dimensions of the input frame, specifically the height and width. frame.shape returns a tuple representing the dimensions of the frame. If the frame is in grayscale, it has two dimensions: (height, width). If it’s in color, it has three: (height, width, channels). frame.shape[:2] extracts only the first two values (height and width), ignoring any color channel information if present.
-        black_frame= np.zeros((height, width), np.uint8) #generates an array of zeros with a shape of (height, width). Each pixel has a value of 0, which represents black in grayscale. black_frame is a blank image, completely black and the same size as frame.
-        mask=np.full((height, width), 255, np.uint8) #creates a white mask image with the same dimensions as frame.
-        cv2.fillPoly(mask, [region], (0,0,0)) # fills the area within the region polygon in the mask image with black (0)
-        eye= cv2.bitwise_not(black_frame, frame.copy(), mask=mask) # This line isolates the eye region by combining black_frame and frame using the mask as a guide
-
         # cropping on the eye
-        margin=5 #A small margin helps ensure that when the eye area is cropped, it captures a bit of the surrounding area. This is useful because detection might not be exact, so a margin provides a better capture of the eye.
-        #These lines determine the left and right bounds of the cropping area around the eye
-        min_x=np.min(region[:,0])- margin # finds the smallest x-coordinate (leftmost point of the eye landmarks).
-        max_x=np.max(region[:,0])+ margin # finds the largest x-coordinate (rightmost point of the eye landmarks).
-
-        #These lines determine the top and bottom bounds of the cropping area around the eye.
-        min_y = np.min(region[:,1]) - margin # finds the smallest y-coordinate (topmost point of the eye landmarks).
-        max_y = np.max(region[:,1]) + margin # finds the largest y-coordinate (bottommost point of the eye landmarks).
-
-        self.frame= eye[min_y:max_y, min_x:max_x] # crops the isolated eye area from the eye image, storing it in self.frame. eye[min_y:max_y, min_x:max_x] selects the region within the calculated min_y, max_y, min_x, and max_x boundaries. This cropping operation extracts only the eye area, along with a slight margin around it. self.frame is assigned this cropped eye image, so self.frame now contains only the eye region.
+        margin=self.MARGIN #A small margin helps ensure that when the eye area is cropped, it captures a bit of the surrounding area. This is useful because detection might not be exact, so a margin provides a better capture of the eye.
+        height, width = frame.shape[:2]
+        #The box is clipped to the frame, a negative index would wrap around the image instead of stopping at its edge
+        (min_x, min_y), (max_x, max_y) = region.min(axis=0) - margin, region.max(axis=0) + margin
+        min_x, min_y = min(max(int(min_x), 0), width), min(max(int(min_y), 0), height)
+        max_x, max_y = max(min(int(max_x), width), min_x), max(min(int(max_y), height), min_y)
+        if max_x - min_x <= 2 * margin or max_y - min_y <= 2 * margin: #The eye is (almost) outside the image, nothing would be left once the margins are cropped
+            raise ValueError("eye is outside the frame")
+
+        # Applying a mask to get only the eye, on the cropped patch only
+        patch = frame[min_y:max_y, min_x:max_x]
+        mask = self._mask_buffer(patch.shape[:2]) #white everywhere, except inside the eye polygon
+        cv2.fillPoly(mask, [region], 0, offset=(-min_x, -min_y))
+        self.frame = cv2.bitwise_or(patch, mask) #pixels inside the polygon are kept, the rest of the patch becomes white
 
         self.origin=(min_x, min_y)  # records the top-left corner of the cropped eye area in the original image. Knowing this origin point can be helpful if you need to map the cropped eye area back to its original location in the larger image.
 
@@ -77,23 +116,18 @@ class Eye(object): #This class is responsible for isolating an eye from the imag
         It's the division of the width of the eye, by its height.
 
         Arguments:
-            landmarks (dlib.full_object_detection): Facial landmarks for the face region
+            landmarks (numpy.ndarray): (68, 2) facial landmarks for the face region
             points (list): Points of an eye (from the 68 Multi-PIE landmarks)
 
         Returns:
             The computed ratio
         """
-        #Defines two points to measure the horizontal distance (width) of the eye.
-        left =(landmarks.part(points[0]).x, landmarks.part(points[0]).y) # left is set to the coordinates of the first landmark in points, which is the left corner of the eye.
-        right=(landmarks.part(points[3]).x, landmarks.part(points[3]).y) # right is set to the coordinates of the fourth landmark in points, which is the right corner of the eye. now have the (x, y) coordinates for the left and right corners of the eye, which will help us calculate the eye’s width.
-
-        #Defines two points to measure the vertical distance (height) of the eye.
-        top= self._middle_point(landmarks.part(points[1]), landmarks.part(points[2])) # top is calculated as the midpoint between the landmarks at indices points[1] and points[2]. These landmarks define the top portion of the eye.
-        bottom = self._middle_point(landmarks.part(points[5]), landmarks.part(points[4])) # bottom is calculated as the midpoint between the landmarks at indices points[5] and points[4], defining the bottom of the eye.
+        #One conversion of the six eye points to Python numbers, see blinking_ratios for many faces at once
+        (left_x, left_y), (x1, y1), (x2, y2), (right_x, right_y), (x4, y4), (x5, y5) = landmarks[points].tolist()
 
-        #math.hypot(x, y) computes the Euclidean distance: sqrt(x^2+y^2)
-        eye_width = math.hypot((left[0] - right[0]), (left[1] - right[1])) # left[0] - right[0] gives the x-axis distance between left and right. left[1] - right[1] gives the y-axis distance between left and right.
-        eye_height = math.hypot((top[0] - bottom[0]), (top[1] - bottom[1]))
+        #Width from corner to corner, height between the middles of the top and bottom lids
+        eye_width = math.hypot(left_x - right_x, left_y - right_y)
+        eye_height = math.hypot(int((x1 + x2) / 2) - int((x5 + x4) / 2), int((y1 + y2) / 2) - int((y5 + y4) / 2))
 
         try:
             ratio= eye_width / eye_height #ratio = eye_width / eye_height gives a ratio that indicates how "open" the eye is.
@@ -108,9 +142,11 @@ class Eye(object): #This class is responsible for isolating an eye from the imag
 
         Arguments:
             original_frame (numpy.ndarray): Frame passed by the user
-            landmarks (dlib.full_object_detection): Facial landmarks for the face region
+            landmarks (numpy.ndarray): (68, 2) facial landmarks for the face region
             side: Indicates whether it's the left eye (0) or the right eye (1)
             calibration (calibration.Calibration): Manages the binarization threshold value
+
+        Raises ValueError when the eye is cut by the edge of the frame, see _isolate.
         """
         # Determine which set of points to use based on the side argument.
         if side ==0:
@@ -123,11 +159,14 @@ class Eye(object): #This class is responsible for isolating an eye from the imag
         self.blinking = self._blinking_ratio(landmarks, points)  # calculated ratio is stored in self.blinking and will help track whether the eye is open or closed
         self._isolate(original_frame, landmarks, points) # The result is stored in self.frame, the isolated eye frame, and self.origin, which records the top-left coordinates of the eye in the original frame.
 
+        if calibration.is_verifying():  # Thresholds loaded from a profile are checked against the first frames, and dropped if the lighting changed
+            calibration.verify(self.frame, side)
+
         if not calibration.is_complete():  # calibration.is_complete() checks if the calibration is already finished. If not, it evaluates the current eye frame to fine-tune the threshold settings.
             calibration.evaluate(self.frame, side) # calibration.evaluate(self.frame, side) analyzes the isolated eye frame to help determine the optimal threshold for binarizing the pupil area.
 
         threshold= calibration.threshold(side)   # calibration.threshold(side) retrieves the threshold value based on the eye’s side (left or right), which helps isolate the pupil area in the next step.
-        self.pupil= Pupil(self.frame, threshold)  # The Pupil class is initialized with self.frame (the isolated eye image) and the threshold. This object will detect the pupil position, storing it in self.pupil.
+        self.pupil= Pupil(self.frame, threshold, self.pupil_method)  # The Pupil class is initialized with self.frame (the isolated eye image) and the threshold. This object will detect the pupil position, storing it in self.pupil.
 
 
 
@@ -1,9 +1,29 @@
 from __future__ import division
-import os
+import time
+from collections import deque
 import cv2
 import dlib
-from .eye import Eye
+import numpy as np
+from . import models
+from .eye import Eye, landmarks_array, blinking_ratios
+from .pupil import Pupil
 from .calibration import Calibration
+from .instrumentation import Instrumentation
+from .motion_gate import MotionGate
+from .recalibration import Recalibrator
+from .preview import draw_pupils
+from .result import GazeResult, EMPTY_RESULT, RIGHT, LEFT, CENTER
+
+def _scale_landmarks(landmarks, transform):
+    """Returns the landmarks moved into a cropped and resized eye region
+
+    Arguments:
+        landmarks (numpy.ndarray): (68, 2) landmarks in frame coordinates
+        transform (tuple): (x, y, scale) of the region
+    """
+    x, y, scale = transform
+    return np.rint((landmarks - (x, y)) * scale).astype(np.int32)
+
 
 class GazeTracking(object):
     """
@@ -12,45 +32,364 @@ class GazeTracking(object):
     and pupils and allows to know if the eyes are open or closed
     """
 
-    def __init__(self):
+    def __init__(self, tracking=False, redetect_interval=10, tracking_padding=0.1, detection_scale=1.0,
+                 instrumentation=False, motion_gate=False, model_path=None, eye_scale=1.0,
+                 pupil_method=Pupil.CONTOURS, recalibration=False, multi_face=False, user_selection="largest"):
+        """
+        Arguments:
+            tracking (bool): Reuse the previous frame's landmarks as the face box
+                instead of running the face detector on every frame
+            redetect_interval (int): Forces a full detection after that many tracked frames
+            tracking_padding (float): Padding added around the landmarks box, as a
+                fraction of the face size
+            detection_scale (float): Scale applied to the frame before running the
+                face detector (1.0 runs it on the full frame)
+            instrumentation (bool): Records stage latencies and health counters,
+                read them with stats()
+            motion_gate (bool): Reuses the eyes of the last analyzed frame while
+                the eye regions don't change, see MotionGate
+            model_path (str): Landmark model, the bundled 68 landmarks model by default.
+                Models are loaded on first use and shared by every instance.
+            eye_scale (float): Scale of the region around the eyes that the eyes
+                and pupils are analyzed in (1.0 keeps the full resolution)
+            pupil_method (str): Pupil.CONTOURS, or Pupil.COMPONENTS for sub-pixel pupil
+                centers with a confidence, more accurate for about the same cost
+            recalibration (bool): Searches new thresholds in the background when the
+                lighting of the eyes drifts, see Recalibrator
+            multi_face (bool): Predicts the landmarks of every detected face on every frame,
+                in faces, with their blink ratios in face_blink_ratios, and analyzes the eyes
+                of the user only. Off, the first face is used.
+            user_selection (str): How the user is picked among the faces: "largest"
+                face, or "tracked", the face closest to where the user was
+        """
         self.frame=None
         self.eye_left=None
         self.eye_right= None
+        self.result = EMPTY_RESULT  #Everything derived from the last frame, computed once per refresh
         self.calibration = Calibration()
 
-        # _face_detector is used to detect face
-        self._face_detector = dlib.get_frontal_face_detector()
+        self.tracking = tracking
+        self.redetect_interval = redetect_interval
+        self.tracking_padding = tracking_padding
+        self.detection_scale = detection_scale
+        self.eye_scale = eye_scale
+        self.pupil_method = pupil_method
+        self._eye_transform = None  #(x, y, scale, right, bottom) of the eye region of the last frame, see _eye_transform_for
+        self._face_box = None
+        self._frames_since_detection = 0
+        self.multi_face = multi_face
+        self.user_selection = user_selection
+        self.faces = None  #(faces, 68, 2) landmarks of every face of the last frame in multi-face mode
+        self.face_blink_ratios = None  #(faces,) blink ratio of every face, NaN where it can't be computed
+        self.user_index = None  #Index of the user in faces
+        self._user_center = None
+
+        # Counters used to measure what the tracking mode saves
+        self.detector_calls = 0
+        self.tracked_frames = 0
+        self.frame_time = None
+        self.detect_time = None  #Time spent in the face detector during the last refresh, None if it didn't run
+        self.eye_time = None  #Time spent isolating the eyes and locating the pupils during the last refresh, None if it didn't run
+        self._detector_times = deque(maxlen=256)
+        self.instrumentation = Instrumentation() if instrumentation else None
+        self.motion_gate = MotionGate() if motion_gate else None
+        self.recalibration = Recalibrator(self.calibration) if recalibration else None
+        self.reused = False  #True when the last refresh reused the previous eyes
 
-        # _predictor is used to get facial landmarks of a given face
-        cwd=os.path.abspath(os.path.dirname(__file__))
-        model_path= os.path.abspath(os.path.join(cwd, "trained_models/shape_predictor_68_face_landmarks.dat"))
-        self._predictor = dlib.shape_predictor(model_path)
+        self.model_path = model_path
+
+    @property
+    def _face_detector(self):
+        """_face_detector is used to detect face"""
+        return models.face_detector()
+
+    @property
+    def _predictor(self):
+        """_predictor is used to get facial landmarks of a given face"""
+        return models.shape_predictor(self.model_path)
+
+    def warmup(self):
+        """Loads the shared models and runs them once, so the first frame isn't slow"""
+        models.warmup(self.model_path)
 
     @property
     def pupils_located(self):
         """Check that the pupils have been located"""
-        try:
-            int(self.eye_left.pupil.x)
-            int(self.eye_left.pupil.y)
-            int(self.eye_right.pupil.x)
-            int(self.eye_right.pupil.y)
-            return True
-        except Exception:
+        return self.result.pupils_located
+
+    def _detect_faces(self, frame):
+        """Runs the face detector and returns the faces found, in frame coordinates
+
+        Arguments:
+            frame (numpy.ndarray): Grayscale frame
+        """
+        self.detector_calls += 1
+        start = time.perf_counter()
+        self._detector_times.append(start)
+
+        if self.detection_scale == 1.0:
+            faces = self._face_detector(frame)
+        else:
+            small = cv2.resize(frame, None, fx=self.detection_scale, fy=self.detection_scale,
+                               interpolation=cv2.INTER_AREA)
+            faces = self._face_detector(small)
+
+        self.detect_time = time.perf_counter() - start
+        if self.instrumentation is not None:
+            self.instrumentation.observe("detect", self.detect_time)
+        if self.detection_scale == 1.0:
+            return list(faces)
+        scale = 1.0 / self.detection_scale
+        return [dlib.rectangle(int(face.left() * scale), int(face.top() * scale),
+                               int(face.right() * scale), int(face.bottom() * scale)) for face in faces]
+
+    def _landmarks_box(self, landmarks, frame):
+        """Returns the padded box around the landmarks, clipped to the frame
+
+        Arguments:
+            landmarks (numpy.ndarray): (68, 2) facial landmarks of the face
+            frame (numpy.ndarray): Frame the landmarks were found in
+        """
+        (left, top), (right, bottom) = landmarks.min(axis=0).tolist(), landmarks.max(axis=0).tolist()
+        pad_x = int((right - left) * self.tracking_padding)
+        pad_y = int((bottom - top) * self.tracking_padding)
+
+        height, width = frame.shape[:2]
+        return dlib.rectangle(max(left - pad_x, 0), max(top - pad_y, 0),
+                              min(right + pad_x, width - 1), min(bottom + pad_y, height - 1))
+
+    @staticmethod
+    def _landmarks_plausible(landmarks, box):
+        """Checks that landmarks predicted inside a tracked box still look like a face.
+        The predictor always returns 68 points, even when the face moved away.
+
+        Arguments:
+            landmarks (numpy.ndarray): (68, 2) landmarks predicted in the box
+            box (dlib.rectangle): Box used for the prediction
+        """
+        width, height = (landmarks.max(axis=0) - landmarks.min(axis=0)).tolist()
+
+        # The face must fill most of the box, else it moved or shrank
+        if width < 0.6 * box.width() or height < 0.6 * box.height():
+            return False
+        # Outer eye corners must be in order and above the chin
+        if landmarks[36, 0] >= landmarks[45, 0]:
+            return False
+        if max(landmarks[36, 1], landmarks[45, 1]) >= landmarks[8, 1]:
             return False
+        return True
+
+    def _predict(self, frame, box):
+        """Runs the landmark predictor on a face box, returns a (68, 2) array"""
+        if self.instrumentation is None:
+            return landmarks_array(self._predictor(frame, box))
+        start = time.perf_counter()
+        landmarks = landmarks_array(self._predictor(frame, box))
+        self.instrumentation.observe("landmarks", time.perf_counter() - start)
+        return landmarks
+
+    def _set_faces(self, batch, index):
+        """Keeps the landmarks of every face of the frame and computes their blink ratios in one pass
+
+        Arguments:
+            batch (numpy.ndarray): (faces, 68, 2) landmarks
+            index (int): Index of the user in batch
+        """
+        self.faces = batch
+        self.user_index = index
+        self.face_blink_ratios = (blinking_ratios(batch, Eye.LEFT_EYE_POINTS)
+                                  + blinking_ratios(batch, Eye.RIGHT_EYE_POINTS)) / 2
+        return batch[index]
+
+    def _clear_faces(self):
+        self.faces = None
+        self.face_blink_ratios = None
+        self.user_index = None
+
+    def _select_user(self, frame, faces):
+        """Predicts the landmarks of every face and returns the user's
+
+        Arguments:
+            frame (numpy.ndarray): Grayscale frame
+            faces (list): dlib.rectangle of the detected faces
+        """
+        batch = np.stack([self._predict(frame, face) for face in faces])  #(faces, 68, 2)
+        low, high = batch.min(axis=1), batch.max(axis=1)
+        if self.user_selection == "tracked" and self._user_center is not None:
+            distances = np.hypot(*((low + high) / 2 - self._user_center).T)
+            index = int(np.argmin(distances))
+        else:
+            index = int(np.argmax(np.prod(high - low, axis=1)))
+        if self.instrumentation is not None and len(faces) > 1:
+            self.instrumentation.count("other_faces", len(faces) - 1)
+        return self._set_faces(batch, index)
+
+    def _track_faces(self, frame):
+        """Predicts every face of the last frame in its previous box, in multi-face
+        mode, so faces stays current between detections. Faces that moved away are
+        dropped until the next detection. Returns the landmarks of the user, or
+        None when the user was lost.
+
+        Arguments:
+            frame (numpy.ndarray): Grayscale frame
+        """
+        batch = []
+        index = None
+        for position, previous in enumerate(self.faces):
+            box = self._face_box if position == self.user_index else self._landmarks_box(previous, frame)
+            landmarks = self._predict(frame, box)
+            if not self._landmarks_plausible(landmarks, box):
+                continue
+            if position == self.user_index:
+                index = len(batch)
+            batch.append(landmarks)
+        if index is None:
+            return None
+        return self._set_faces(np.stack(batch), index)
+
+    def _find_landmarks(self, frame):
+        """Returns the facial landmarks of the face, or None if no face is found.
+        In tracking mode the previous face box is used and the detector only runs
+        when the tracked landmarks are rejected or the re-detection interval is reached.
+
+        Arguments:
+            frame (numpy.ndarray): Grayscale frame
+        """
+        if self.tracking and self._face_box is not None and self._frames_since_detection < self.redetect_interval:
+            if self.multi_face and self.faces is not None:
+                landmarks = self._track_faces(frame)
+            else:
+                landmarks = self._predict(frame, self._face_box)
+                if not self._landmarks_plausible(landmarks, self._face_box):
+                    landmarks = None
+            if landmarks is not None:
+                self._frames_since_detection += 1
+                self.tracked_frames += 1
+                self._face_box = self._landmarks_box(landmarks, frame)
+                self._user_center = (landmarks.min(axis=0) + landmarks.max(axis=0)) / 2
+                if self.instrumentation is not None:
+                    self.instrumentation.count("tracker_frames")
+                return landmarks
+            if self.instrumentation is not None:
+                self.instrumentation.count("tracker_rejected")
+
+        faces = self._detect_faces(frame)
+        self._frames_since_detection = 0
+        if self.instrumentation is not None:
+            self.instrumentation.count("detector_frames")
+        if not faces:
+            self._face_box = None
+            self._clear_faces()
+            return None
+
+        if self.multi_face:
+            landmarks = self._select_user(frame, faces)
+        else:
+            landmarks = self._predict(frame, faces[0])
+        self._face_box = self._landmarks_box(landmarks, frame)
+        self._user_center = (landmarks.min(axis=0) + landmarks.max(axis=0)) / 2
+        return landmarks
 
     def _analyze(self):
         """Detects the face and initialize Eye objects"""
+        stats = self.instrumentation
+        if stats is not None:
+            start = time.perf_counter()
         frame = cv2.cvtColor(self.frame, cv2.COLOR_BGR2GRAY)
-        faces = self._face_detector(frame)
+        if stats is not None:
+            stats.observe("convert", time.perf_counter() - start)
+
+        gate = self.motion_gate
+        if gate is not None and self.eye_left is not None and self.calibration.is_complete():
+            if gate.unchanged(self._eye_region(frame, self._eye_transform), (self.eye_left, self.eye_right)):
+                self.reused = True
+                if stats is not None:
+                    stats.count("gated_frames")
+                return
+
+        eye_frame = self._analyze_face(frame)
+        if gate is not None:
+            gate.update(eye_frame, None if self.eye_left is None else (self.eye_left, self.eye_right))
+
+    def _eye_transform_for(self, frame, landmarks):
+        """Returns the (x, y, scale, right, bottom) of the region around both eyes, or None
+        at full scale. (x, y) and (right, bottom) are its corners in frame coordinates, and
+        (x, y, scale) maps frame coordinates to the scaled region.
+
+        Arguments:
+            frame (numpy.ndarray): Grayscale frame
+            landmarks (numpy.ndarray): (68, 2) facial landmarks of the face
+        """
+        if self.eye_scale == 1.0:
+            return None
+        points = landmarks[Eye.LEFT_EYE_POINTS + Eye.RIGHT_EYE_POINTS]
+        margin = int(2 * Eye.MARGIN / self.eye_scale)  #Keeps the margin of Eye inside the region once scaled
+        (x, y), (right, bottom) = (points.min(axis=0) - margin).tolist(), (points.max(axis=0) + margin).tolist()
+        return (max(x, 0), max(y, 0), self.eye_scale, min(right, frame.shape[1]), min(bottom, frame.shape[0]))
+
+    @staticmethod
+    def _eye_region(frame, transform):
+        """Returns the part of the frame the eyes are analyzed in
+
+        Arguments:
+            frame (numpy.ndarray): Grayscale frame
+            transform (tuple): From _eye_transform_for, None for the full frame
+        """
+        if transform is None:
+            return frame
+        x, y, scale, right, bottom = transform
+        return cv2.resize(frame[y:bottom, x:right], None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+
+    def _analyze_face(self, frame):
+        """Finds the landmarks of the face and initialize Eye objects
 
+        Arguments:
+            frame (numpy.ndarray): Grayscale frame
+
+        Returns:
+            The frame the eyes were analyzed in
+        """
+        stats = self.instrumentation
+        landmarks = self._find_landmarks(frame)
+
+        if landmarks is None:
+            self.eye_left = None
+            self.eye_right = None
+            if stats is not None:
+                stats.count("no_face_frames")
+            return frame
+
+        self._eye_transform = self._eye_transform_for(frame, landmarks)
+        if self._eye_transform is not None:
+            frame = self._eye_region(frame, self._eye_transform)
+            landmarks = _scale_landmarks(landmarks, self._eye_transform[:3])
+
+        if stats is not None and not self.calibration.is_complete():
+            stats.count("calibration_frames")
+
+        start = time.perf_counter()
         try:
-            landmarks = self._predictor(frame, faces[0])
-            self.eye_left = Eye(frame, landmarks, 0, self.calibration)
-            self.eye_right = Eye(frame, landmarks, 1, self.calibration)
+            self.eye_left = Eye(frame, landmarks, 0, self.calibration, self.pupil_method)
+            self.eye_right = Eye(frame, landmarks, 1, self.calibration, self.pupil_method)
+            self.eye_time = time.perf_counter() - start
 
-        except IndexError:
+        except (IndexError, ValueError):  #Landmarks missing, or an eye at the edge of the frame
             self.eye_left = None
             self.eye_right = None
+            if stats is not None:
+                stats.count("eye_errors")
+            return frame
+
+        if self.recalibration is not None:
+            self.recalibration.observe(self.eye_left, self.eye_right)
+
+        if stats is not None:
+            stats.observe("eyes", self.eye_time)
+            if self.eye_left.pupil.x is None:
+                stats.count("pupil_not_found_left")
+            if self.eye_right.pupil.x is None:
+                stats.count("pupil_not_found_right")
+        return frame
 
     def refresh(self, frame):
         """Refreshes the frame and analyzes it.
@@ -58,79 +397,78 @@ class GazeTracking(object):
         Arguments:
             frame (numpy.ndarray): The frame to analyze
         """
+        start = time.perf_counter()
+        if self.motion_gate is not None:
+            cpu_start = time.process_time()
         self.frame = frame
+        self.reused = False
+        self.detect_time = None
+        self.eye_time = None
         self._analyze()
+        if not self.reused:
+            transform = self._eye_transform[:3] if self._eye_transform is not None else None
+            self.result = GazeResult.from_eyes(self.eye_left, self.eye_right, transform)
+        self.frame_time = time.perf_counter() - start
+        if self.motion_gate is not None:
+            self.motion_gate.record_cpu(self.reused, time.process_time() - cpu_start)
+        if self.instrumentation is not None:
+            self.instrumentation.count("frames")
+            self.instrumentation.observe("refresh", self.frame_time)
+
+    def stats(self):
+        """Returns a snapshot of the stage latencies and health counters,
+        or None when instrumentation is off"""
+        if self.instrumentation is not None:
+            return self.instrumentation.stats()
+
+    def detector_calls_per_second(self):
+        """Returns how many times the face detector ran during the last second"""
+        now = time.perf_counter()
+        return sum(1 for t in self._detector_times if now - t <= 1.0)
 
     def pupil_left_coords(self):
         """Returns the coordinates of the left pupil"""
-        if self.pupils_located:
-            x = self.eye_left.origin[0] + self.eye_left.pupil.x
-            y = self.eye_left.origin[1] + self.eye_left.pupil.y
-            return (x, y)
+        return self.result.pupil_left
 
     def pupil_right_coords(self):
         """Returns the coordinates of the right pupil"""
-        if self.pupils_located:
-            x = self.eye_right.origin[0] + self.eye_right.pupil.x
-            y = self.eye_right.origin[1] + self.eye_right.pupil.y
-            return (x, y)
+        return self.result.pupil_right
 
     def horizontal_ratio(self):
         """Returns a number between 0.0 and 1.0 that indicates the
         horizontal direction of the gaze. The extreme right is 0.0,
         the center is 0.5 and the extreme left is 1.0
         """
-        if self.pupils_located:
-            pupil_left = self.eye_left.pupil.x / (self.eye_left.center[0] * 2 - 10)
-            pupil_right = self.eye_right.pupil.x / (self.eye_right.center[0] * 2 - 10)
-            return (pupil_left + pupil_right) / 2
+        return self.result.horizontal_ratio
 
     def vertical_ratio(self):
         """Returns a number between 0.0 and 1.0 that indicates the
         vertical direction of the gaze. The extreme top is 0.0,
         the center is 0.5 and the extreme bottom is 1.0
         """
-        if self.pupils_located:
-            pupil_left = self.eye_left.pupil.y / (self.eye_left.center[1] * 2 - 10)
-            pupil_right = self.eye_right.pupil.y / (self.eye_right.center[1] * 2 - 10)
-            return (pupil_left + pupil_right) / 2
+        return self.result.vertical_ratio
 
     def is_right(self):
         """Returns true if the user is looking to the right"""
-        if self.pupils_located:
-            return self.horizontal_ratio() <= 0.35
+        if self.result.pupils_located:
+            return self.result.direction == RIGHT
 
     def is_left(self):
         """Returns true if the user is looking to the left"""
-        if self.pupils_located:
-            return self.horizontal_ratio() >= 0.65
+        if self.result.pupils_located:
+            return self.result.direction == LEFT
 
     def is_center(self):
         """Returns true if the user is looking to the center"""
-        if self.pupils_located:
-            return self.is_right() is not True and self.is_left() is not True
+        if self.result.pupils_located:
+            return self.result.direction == CENTER
 
     def is_blinking(self):
         """Returns true if the user closes his eyes"""
-        if self.pupils_located:
-            blinking_ratio = (self.eye_left.blinking + self.eye_right.blinking) / 2
-            return blinking_ratio > 3.8
+        return self.result.blinking
 
     def annotated_frame(self):
         """Returns the main frame with pupils highlighted"""
         frame = self.frame.copy()
-
-        if self.pupils_located:
-            color = (0, 255, 0)
-            x_left, y_left = self.pupil_left_coords()
-            x_right, y_right = self.pupil_right_coords()
-            cv2.line(frame, (x_left - 5, y_left), (x_left + 5, y_left), color)
-            cv2.line(frame, (x_left, y_left - 5), (x_left, y_left + 5), color)
-            cv2.line(frame, (x_right - 5, y_right), (x_right + 5, y_right), color)
-            cv2.line(frame, (x_right, y_right - 5), (x_right, y_right + 5), color)
-
+        draw_pupils(frame, self.result)
         return frame
-
-
-
-
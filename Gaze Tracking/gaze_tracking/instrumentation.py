@@ -0,0 +1,176 @@
+from __future__ import division
+import os
+import socket
+import threading
+from collections import Counter
+
+
+class Histogram(object):
+    """Latency histogram with fixed buckets, in seconds"""
+
+    BUCKETS = (0.0005, 0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1.0)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        index = 0
+        for bound in self.BUCKETS:
+            if seconds <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q-th quantile"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "mean": self.sum / self.count if self.count else None,
+            "max": self.max,
+            "p50": self.quantile(0.5),
+            "p99": self.quantile(0.99),
+            "buckets": dict(zip(self.BUCKETS + (float("inf"),), self.counts)),
+        }
+
+
+class Instrumentation(object):
+    """
+    Collects per-stage latency histograms and health counters of a
+    GazeTracking instance. It is only created when instrumentation is
+    turned on, the tracker skips every measurement otherwise.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.histograms = {}
+        self.counters = Counter()
+        self._server = None
+
+    def observe(self, stage, seconds):
+        """Records the duration of a stage
+
+        Arguments:
+            stage (str): Name of the stage
+            seconds (float): Duration
+        """
+        with self._lock:
+            histogram = self.histograms.get(stage)
+            if histogram is None:
+                histogram = self.histograms[stage] = Histogram()
+            histogram.observe(seconds)
+
+    def count(self, name, value=1):
+        """Increments a counter
+
+        Arguments:
+            name (str): Name of the counter
+            value (int): Increment
+        """
+        with self._lock:
+            self.counters[name] += value
+
+    def stats(self):
+        """Returns a snapshot of the counters and latencies as plain dicts"""
+        with self._lock:
+            return {
+                "counters": dict(self.counters),
+                "latency": {stage: histogram.snapshot() for stage, histogram in self.histograms.items()},
+            }
+
+    def reset(self):
+        with self._lock:
+            self.histograms = {}
+            self.counters = Counter()
+
+    def prometheus_text(self, prefix="gaze"):
+        """Returns the metrics in the Prometheus text exposition format"""
+        lines = []
+        with self._lock:
+            for name in sorted(self.counters):
+                metric = "{}_{}_total".format(prefix, name)
+                lines.append("# TYPE {} counter".format(metric))
+                lines.append("{} {}".format(metric, self.counters[name]))
+
+            metric = "{}_stage_seconds".format(prefix)
+            lines.append("# TYPE {} histogram".format(metric))
+            for stage in sorted(self.histograms):
+                histogram = self.histograms[stage]
+                cumulative = 0
+                for bound, count in zip(histogram.BUCKETS, histogram.counts):
+                    cumulative += count
+                    lines.append('{}_bucket{{stage="{}",le="{}"}} {}'.format(metric, stage, bound, cumulative))
+                lines.append('{}_bucket{{stage="{}",le="+Inf"}} {}'.format(metric, stage, histogram.count))
+                lines.append('{}_sum{{stage="{}"}} {}'.format(metric, stage, histogram.sum))
+                lines.append('{}_count{{stage="{}"}} {}'.format(metric, stage, histogram.count))
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="gaze"):
+        """Writes the metrics to a file, for the node exporter textfile collector.
+        The file is replaced atomically so readers never see a partial dump.
+
+        Arguments:
+            path (str): Destination file
+            prefix (str): Prefix of the metric names
+        """
+        temporary = path + ".tmp"
+        with open(temporary, "w") as file:
+            file.write(self.prometheus_text(prefix))
+        os.replace(temporary, path)
+
+    def serve(self, path):
+        """Dumps the metrics to every client connecting to a Unix socket, from a
+        background thread. `socat - UNIX-CONNECT:<path>` prints them.
+
+        Arguments:
+            path (str): Path of the Unix socket
+        """
+        if os.path.exists(path):
+            os.remove(path)
+        server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        server.bind(path)
+        server.listen(4)
+        server.settimeout(0.5)
+        self._server = server
+
+        def loop():
+            while self._server is server:
+                try:
+                    client, _ = server.accept()
+                except socket.timeout:
+                    continue
+                except OSError:
+                    break
+                try:
+                    client.settimeout(1.0)  #A client that doesn't read can't hold the thread
+                    client.sendall(self.prometheus_text().encode("utf-8"))
+                except OSError:
+                    pass  #The client went away (broken pipe, reset, timeout), the next one is served
+                finally:
+                    client.close()
+
+        threading.Thread(target=loop, daemon=True).start()
+
+    def close(self):
+        """Stops the socket server started by serve()"""
+        if self._server is not None:
+            self._server.close()
+            self._server = None
@@ -0,0 +1,259 @@
+"""
+End-to-end latency harness. Frames are replayed from a video (or
+generated) at a fixed rate by a ReplayCamera, go through the same
+Pipeline and CommandChannel as main.py, and the commands are written to a
+MemoryTransport that records when they arrive. The report gives the
+latency from frame capture to command arrival, the dropped frames and the
+command jitter.
+
+    python -m gaze_tracking.latency session.mp4 --fps 30 --tracking --motion-gate
+    python -m gaze_tracking.latency --synthetic 300 --max-p99 150 -o latency.json
+
+The synthetic frames show a face looking left, ahead and right in turn.
+The dlib models can't find it, so its landmarks are given to the tracker
+directly (benchmark.synthetic_tracker): the run needs neither the models
+nor a camera, and every stage after the landmarks is measured.
+
+The exit code is 1 when no command reached the fake serial port, and with
+--max-p99 when the p99 latency (ms) is above the limit, so the check can
+run in CI.
+"""
+from __future__ import division
+import argparse
+import json
+import sys
+import time
+import numpy as np
+from .command_channel import CommandChannel, FramedProtocol, LineProtocol, MemoryTransport
+from .pipeline import Pipeline
+from .sources import ReplayCamera
+
+
+def direction_command(gaze, timestamp):
+    """Command for the gaze direction, STOP when the pupils aren't found.
+    main.py adds the blink gestures on top of this."""
+    if gaze.is_right():
+        return "RIGHT"
+    elif gaze.is_left():
+        return "LEFT"
+    elif gaze.is_center():
+        return "CENTER"
+    return "STOP"
+
+
+def _percentiles(values):
+    if not values:
+        return {"count": 0, "p50_ms": None, "p95_ms": None, "p99_ms": None, "max_ms": None, "std_ms": None}
+    values = np.asarray(values) * 1000
+    return {
+        "count": len(values),
+        "p50_ms": float(np.percentile(values, 50)),
+        "p95_ms": float(np.percentile(values, 95)),
+        "p99_ms": float(np.percentile(values, 99)),
+        "max_ms": float(values.max()),
+        "std_ms": float(values.std()),
+    }
+
+
+def command_latencies(trails, arrivals):
+    """Matches each command change with the first write of that command after the
+    frame that produced it was analyzed. Returns (latencies, unmatched changes).
+
+    Arguments:
+        trails (list): FrameTrail of the analyzed frames, oldest first
+        arrivals (list): (time, command) of the writes, oldest first
+    """
+    changes = []
+    previous = None
+    for trail in trails:
+        if trail.sent is None:
+            continue
+        if trail.command != previous:
+            changes.append(trail)
+            previous = trail.command
+
+    latencies = []
+    unmatched = 0
+    position = 0
+    for index, trail in enumerate(changes):
+        # A change replaced by the next one before it was written never arrives
+        deadline = changes[index + 1].analyzed if index + 1 < len(changes) else float("inf")
+        while position < len(arrivals) and arrivals[position][0] < trail.analyzed:
+            position += 1
+        found = None
+        for arrived, command in arrivals[position:]:
+            if arrived >= deadline:
+                break
+            if command == trail.command:
+                found = arrived
+                break
+        if found is None:
+            unmatched += 1
+        else:
+            latencies.append(found - trail.captured)
+    return latencies, unmatched
+
+
+def measure(source, gaze, decide=direction_command, protocol=None, heartbeat=0.5, delay_per_byte=0.0,
+            max_frame_age=None):
+    """Runs the pipeline on a replayed source until it ends and returns the report
+
+    Arguments:
+        source (ReplayCamera): Frames to play
+        gaze: Tracker refreshed with every analyzed frame (GazeTracking or ResolutionController)
+        decide: Called with the tracker and the capture time, returns the command
+        protocol: FramedProtocol (default) or LineProtocol
+        heartbeat (float): Heartbeat period of the channel, None to disable
+        delay_per_byte (float): Time the fake serial port takes per byte
+        max_frame_age (float): Frames older than that when the analysis picks them up are skipped
+    """
+    transport = MemoryTransport(delay_per_byte)
+    channel = CommandChannel(transport, protocol, heartbeat)
+    pipeline = Pipeline(source, gaze, decide, channel.send, annotate=False, max_frame_age=max_frame_age,
+                        history=len(source.frames) + 1)
+
+    start = time.perf_counter()
+    pipeline.start()
+    while pipeline.running:
+        time.sleep(0.02)
+    pipeline.stop()
+    channel.close(stop=False)
+    duration = time.perf_counter() - start
+
+    trails = pipeline.trails()
+    arrivals = transport.arrivals(channel.protocol)
+    latencies, unmatched = command_latencies(trails, arrivals)
+
+    analyzed = [trail.analyzed - trail.captured for trail in trails]
+    intervals = np.diff([trail.analyzed for trail in trails]) if len(trails) > 1 else []
+    write_intervals = np.diff([arrived for arrived, _ in arrivals]) if len(arrivals) > 1 else []
+    return {
+        "duration_s": duration,
+        "fps": source.fps,
+        "frames": {
+            "emitted": source.emitted,
+            "analyzed": len(trails),
+            "dropped_by_camera": source.dropped,
+            "dropped_by_pipeline": pipeline.frames.dropped,
+            "skipped_too_old": pipeline.skipped,
+            "analysis_rate": pipeline.analysis_rate(),
+        },
+        "frame_to_decision": _percentiles(analyzed),
+        "frame_to_command": _percentiles(latencies),
+        "commands": {
+            "changes": len(latencies) + unmatched,
+            "replaced": unmatched,
+            "writes": len(arrivals),
+            "heartbeats": channel.heartbeats,
+            "bytes": channel.bytes_sent,
+        },
+        # Spread of the time between decisions and between writes to the port
+        "jitter": {
+            "decision_interval": _percentiles(list(intervals)),
+            "write_interval": _percentiles(list(write_intervals)),
+        },
+    }
+
+
+def synthetic_frames(count, width=640, height=480, seed=0, hold=15):
+    """Returns frames of the synthetic face of the benchmark with a little sensor
+    noise, looking left, ahead and right in turn, and the landmarks of the face
+
+    Arguments:
+        count (int): Number of frames
+        width (int): Frame width
+        height (int): Frame height
+        seed (int): Seed of the noise
+        hold (int): Number of frames the face keeps looking in the same direction
+    """
+    from .benchmark import SyntheticFace
+    faces = [SyntheticFace(width, height, seed, gaze) for gaze in (0.25, -0.3, -0.8)]  #LEFT, CENTER, RIGHT
+    rng = np.random.RandomState(seed)
+    frames = []
+    for index in range(count):
+        face = faces[index // hold % len(faces)].frame
+        frames.append(np.clip(face.astype(np.int16) + rng.randint(-3, 4, face.shape), 0, 255).astype(np.uint8))
+    return frames, faces[0].landmarks
+
+
+def print_report(report):
+    frames = report["frames"]
+    print("{} frames at {:g} fps: {} analyzed ({:.1f}/s), {} dropped by the camera, {} by the pipeline, "
+          "{} too old".format(frames["emitted"], report["fps"], frames["analyzed"], frames["analysis_rate"],
+                              frames["dropped_by_camera"], frames["dropped_by_pipeline"], frames["skipped_too_old"]))
+    for name in ("frame_to_decision", "frame_to_command"):
+        stats = report[name]
+        if stats["count"]:
+            print("{:<18} p50 {:7.2f} ms  p95 {:7.2f} ms  p99 {:7.2f} ms  max {:7.2f} ms  ({} samples)".format(
+                name, stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"], stats["count"]))
+        else:
+            print("{:<18} no samples".format(name))
+    commands = report["commands"]
+    print("{} command changes ({} replaced before writing), {} writes, {} heartbeats".format(
+        commands["changes"], commands["replaced"], commands["writes"], commands["heartbeats"]))
+    for name, stats in report["jitter"].items():
+        if stats["count"]:
+            print("{:<18} jitter (std) {:.2f} ms, p99 {:.2f} ms".format(name, stats["std_ms"], stats["p99_ms"]))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Frame to command latency of the gaze pipeline, without hardware")
+    parser.add_argument("path", nargs="?", help="video or directory of frames to replay")
+    parser.add_argument("--synthetic", type=int, metavar="N", help="replay N generated frames instead of a video")
+    parser.add_argument("--fps", type=float, help="replay rate, the video's by default")
+    parser.add_argument("--max-frames", type=int, help="number of frames of the video to replay")
+    parser.add_argument("--tracking", action="store_true", help="track the face instead of detecting it every frame")
+    parser.add_argument("--motion-gate", action="store_true", help="reuse the eyes while they don't change")
+    parser.add_argument("--pupil-method", choices=("contours", "components"), default="contours")
+    parser.add_argument("--detection-scale", type=float, default=1.0)
+    parser.add_argument("--target-latency", type=float, help="adapt the resolutions to this budget per frame (s)")
+    parser.add_argument("--max-frame-age", type=float, help="skip frames older than this (s)")
+    parser.add_argument("--protocol", choices=("framed", "line"), default="framed")
+    parser.add_argument("--baud", type=int, help="emulate the time a serial port at this rate takes to write")
+    parser.add_argument("--heartbeat", type=float, default=0.5)
+    parser.add_argument("--max-p99", type=float, metavar="MS", help="exit with 1 if the p99 frame to command latency is above")
+    parser.add_argument("-o", "--output", help="write the report to this JSON file")
+    args = parser.parse_args(argv)
+
+    options = dict(tracking=args.tracking, motion_gate=args.motion_gate, pupil_method=args.pupil_method,
+                   detection_scale=args.detection_scale)
+    if args.synthetic:
+        frames, landmarks = synthetic_frames(args.synthetic)
+        source = ReplayCamera(frames, args.fps or 30.0)
+        from .benchmark import synthetic_tracker
+        gaze = synthetic_tracker(landmarks, **options)
+    elif args.path:
+        source = ReplayCamera.from_path(args.path, args.fps, args.max_frames)
+        from .gaze_tracking import GazeTracking
+        gaze = GazeTracking(**options)
+        gaze.warmup()
+    else:
+        parser.error("give a video, a directory of frames or --synthetic N")
+
+    if args.target_latency:
+        from .resolution import ResolutionController
+        gaze = ResolutionController(gaze, target_latency=args.target_latency)
+
+    protocol = LineProtocol() if args.protocol == "line" else FramedProtocol()
+    delay_per_byte = 10 / args.baud if args.baud else 0.0   #8N1: 10 bits per byte
+    report = measure(source, gaze, protocol=protocol, heartbeat=args.heartbeat or None,
+                     delay_per_byte=delay_per_byte, max_frame_age=args.max_frame_age)
+    report["config"] = vars(args)
+    print_report(report)
+
+    if args.output:
+        with open(args.output, "w") as file:
+            json.dump(report, file, indent=2)
+
+    if not report["frame_to_command"]["count"]:
+        print("FAIL no command reached the serial port, was a face found?")
+        return 1
+    p99 = report["frame_to_command"]["p99_ms"]
+    if args.max_p99 is not None and (p99 is None or p99 > args.max_p99):
+        print("FAIL p99 {} ms above {} ms".format(p99, args.max_p99))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
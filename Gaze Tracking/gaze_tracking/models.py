@@ -0,0 +1,90 @@
+"""
+Process-wide registry of the dlib models. The face detector and the
+landmark predictor are loaded on first use and shared by every
+GazeTracking instance of the process.
+
+A parent process can call preload() before forking workers, the children
+then share the model pages copy-on-write instead of loading their own.
+`python -m gaze_tracking.benchmark --startup` measures the cold start and
+the memory used by N trackers.
+"""
+from __future__ import division
+import os
+import threading
+import numpy as np
+import dlib
+
+DEFAULT_MODEL_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__),
+                                                  "trained_models/shape_predictor_68_face_landmarks.dat"))
+
+_lock = threading.Lock()
+_face_detector = None
+_predictors = {}
+
+
+def face_detector():
+    """Returns the shared HOG face detector, created on first use"""
+    global _face_detector
+    if _face_detector is None:
+        with _lock:
+            if _face_detector is None:
+                _face_detector = dlib.get_frontal_face_detector()
+    return _face_detector
+
+
+def shape_predictor(model_path=None):
+    """Returns the shared landmark predictor for a model file, loaded on first use
+
+    Arguments:
+        model_path (str): Path of the .dat model, the bundled 68 landmarks model by default
+    """
+    model_path = model_path or DEFAULT_MODEL_PATH
+    predictor = _predictors.get(model_path)
+    if predictor is None:
+        with _lock:
+            predictor = _predictors.get(model_path)
+            if predictor is None:
+                if not os.path.isfile(model_path):
+                    raise IOError("landmark model not found at {}, see the README to download it".format(model_path))
+                predictor = _predictors[model_path] = dlib.shape_predictor(model_path)
+    return predictor
+
+
+def preload(model_path=None):
+    """Loads the detector and the predictor now, e.g. in a parent process before forking workers
+
+    Arguments:
+        model_path (str): Path of the .dat model
+    """
+    face_detector()
+    shape_predictor(model_path)
+
+
+def warmup(model_path=None, size=(480, 640)):
+    """Loads the models and runs them once, so the first real frame isn't slower than the others
+
+    Arguments:
+        model_path (str): Path of the .dat model
+        size (tuple): Height and width of the dummy frame
+    """
+    preload(model_path)
+    frame = np.random.RandomState(0).randint(0, 255, size).astype(np.uint8)
+    face_detector()(frame)
+    height, width = size
+    shape_predictor(model_path)(frame, dlib.rectangle(width // 4, height // 4, 3 * width // 4, 3 * height // 4))
+
+
+def is_loaded(model_path=None):
+    """Returns true if the detector and the predictor are already loaded"""
+    return _face_detector is not None and (model_path or DEFAULT_MODEL_PATH) in _predictors
+
+
+def resident_memory():
+    """Returns the resident set size of the process in bytes (Linux), or None"""
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        return None
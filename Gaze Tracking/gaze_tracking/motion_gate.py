@@ -0,0 +1,110 @@
+from __future__ import division
+import cv2
+import numpy as np
+
+
+class MotionGate(object):
+    """
+    Decides whether the eyes of a new frame changed since the last analyzed
+    frame. The eye regions are downsampled and compared with the ones kept
+    from the last analysis; when the difference stays below the threshold,
+    the previous Eye and Pupil results can be reused.
+
+    The difference is the largest change of a single cell of the downsampled
+    regions, relative to the contrast of the reference eye: an iris that moves
+    by a pixel changes the cells at its edge by a large share of the contrast
+    between the iris and the sclera, even in a dim or washed out image, where
+    a mean over the whole region would hide it. And since at most max_reuse
+    frames in a row are reused (1 by default), a blink or a gaze change the
+    difference misses is still analyzed at most one frame late.
+
+    Check it with `python -m gaze_tracking.benchmark --gate`.
+    """
+
+    MIN_CONTRAST = 16  #Gray levels, keeps a flat region from making noise look like a change
+
+    def __init__(self, threshold=0.1, max_reuse=1, size=(16, 8)):
+        """
+        Arguments:
+            threshold (float): Largest change of a cell of the downsampled eye regions,
+                as a share of the contrast of the reference, below which a frame
+                counts as unchanged
+            max_reuse (int): Number of frames in a row that can reuse the last
+                analysis before a full one is forced
+            size (tuple): Width and height the eye regions are downsampled to
+        """
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self.size = size
+        self._references = None
+        self._reused_in_row = 0
+
+        self.reused_frames = 0
+        self.analyzed_frames = 0
+        self._cpu = {True: 0.0, False: 0.0}
+
+    def _signature(self, frame, eye):
+        """Returns the downsampled region of the frame covered by the eye"""
+        x, y = eye.origin
+        height, width = eye.frame.shape[:2]
+        patch = frame[y:y + height, x:x + width]
+        return cv2.resize(patch, self.size, interpolation=cv2.INTER_AREA).astype(np.int16)
+
+    def unchanged(self, frame, eyes):
+        """Returns true if the eye regions of the frame match the last analyzed ones.
+
+        Arguments:
+            frame (numpy.ndarray): New grayscale frame
+            eyes (list): Eyes of the last analyzed frame
+        """
+        if self._references is None or self._reused_in_row >= self.max_reuse:
+            return False
+
+        for eye, (reference, contrast) in zip(eyes, self._references):
+            difference = np.max(np.abs(self._signature(frame, eye) - reference)) / contrast
+            if difference >= self.threshold:
+                return False
+
+        self._reused_in_row += 1
+        self.reused_frames += 1
+        return True
+
+    def update(self, frame, eyes):
+        """Keeps the eye regions of a frame that was fully analyzed
+
+        Arguments:
+            frame (numpy.ndarray): Grayscale frame
+            eyes (list): Eyes found in the frame, or None when the face was lost
+        """
+        self.analyzed_frames += 1
+        self._reused_in_row = 0
+        if eyes is None:
+            self._references = None
+        else:
+            self._references = []
+            for eye in eyes:
+                reference = self._signature(frame, eye)
+                contrast = max(int(reference.max()) - int(reference.min()), self.MIN_CONTRAST)
+                self._references.append((reference, contrast))
+
+    def reset(self):
+        """Forces a full analysis on the next frame"""
+        self._references = None
+
+    def record_cpu(self, reused, seconds):
+        """Adds the CPU time spent on a frame
+
+        Arguments:
+            reused (bool): Whether the frame reused the last analysis
+            seconds (float): CPU time of the frame
+        """
+        self._cpu[reused] += seconds
+
+    def stats(self):
+        """Returns the number of reused and analyzed frames and their CPU time per frame"""
+        return {
+            "reused_frames": self.reused_frames,
+            "analyzed_frames": self.analyzed_frames,
+            "cpu_per_reused_frame": self._cpu[True] / self.reused_frames if self.reused_frames else None,
+            "cpu_per_analyzed_frame": self._cpu[False] / self.analyzed_frames if self.analyzed_frames else None,
+        }
@@ -0,0 +1,268 @@
+from __future__ import division
+import logging
+import threading
+import time
+from collections import deque
+
+logger = logging.getLogger(__name__)
+
+
+class LatestSlot(object):
+    """
+    Single-slot buffer between two threads. Writing never blocks and
+    replaces the item that is waiting, so the reader always gets the
+    newest one and stale items are dropped instead of queued.
+    """
+
+    def __init__(self):
+        self._cond = threading.Condition()
+        self._item = None
+        self._taken = True
+        self._closed = False
+        self.dropped = 0
+
+    def put(self, item):
+        """Stores the item, dropping the previous one if it wasn't read yet
+
+        Arguments:
+            item: Anything but None
+        """
+        with self._cond:
+            if not self._taken:
+                self.dropped += 1
+            self._item = item
+            self._taken = False
+            self._cond.notify_all()
+
+    def get(self, timeout=None):
+        """Waits for an item that wasn't read yet and returns it.
+        Returns None on timeout or when the slot is closed.
+
+        Arguments:
+            timeout (float): Maximum time to wait, in seconds
+        """
+        with self._cond:
+            self._cond.wait_for(lambda: not self._taken or self._closed, timeout)
+            if self._taken:
+                return None
+            self._taken = True
+            return self._item
+
+    def peek(self):
+        """Returns the newest item without consuming it"""
+        with self._cond:
+            return self._item
+
+    def close(self):
+        """Wakes up the readers, get() returns None from now on"""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class FrameTrail(object):
+    """Timestamps of one frame, from capture to the command it produced.
+    All times come from time.perf_counter()."""
+
+    __slots__ = ("seq", "captured", "analysis_start", "analyzed", "sent", "command")
+
+    def __init__(self, seq, captured):
+        self.seq = seq
+        self.captured = captured
+        self.analysis_start = None
+        self.analyzed = None
+        self.sent = None
+        self.command = None
+
+    def latency(self):
+        """Returns the time between capture and sending, or None if the command wasn't sent"""
+        if self.sent is not None:
+            return self.sent - self.captured
+
+    def as_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+
+class Pipeline(object):
+    """
+    Runs capture, gaze analysis and command sending on three threads.
+    The capture thread keeps only the newest frame, so the analysis always
+    works on the freshest image and the frame rate is only limited by the
+    analysis cost.
+    """
+
+    def __init__(self, camera, gaze, decide, send, annotate=True, max_frame_age=None, history=256, bus=None,
+                 max_errors=10):
+        """
+        Arguments:
+            camera: Object with a read() method returning (ok, frame), like cv2.VideoCapture.
+                When it has a timestamp attribute (see sources), it is used as the capture time.
+            gaze (GazeTracking): Tracker refreshed with every analyzed frame
+            decide: Called with the tracker and the capture time of the frame after
+                each refresh, returns the command to send or an empty string
+            send: Called with each command, from the sender thread
+            annotate (bool): Keeps an annotated copy of the last analyzed frame for display.
+                Off, nothing is copied or drawn on the analysis thread (see preview.Preview).
+            max_frame_age (float): Frames older than that many seconds when the analysis
+                picks them up are skipped
+            history (int): Number of frame trails kept
+            bus (FrameBus): Publishes every analyzed frame, its result and command
+                to the processes reading the bus
+            max_errors (int): Number of frames in a row whose analysis may fail before the
+                pipeline sends STOP and stops
+        """
+        self.camera = camera
+        self.gaze = gaze
+        self.decide = decide
+        self.send = send
+        self.annotate = annotate
+        self.max_frame_age = max_frame_age
+        self.bus = bus
+        self.max_errors = max_errors
+
+        self.frames = LatestSlot()
+        self.commands = LatestSlot()
+        self.skipped = 0
+        self.errors = 0  #Frames whose analysis failed
+        self.failure = None  #Exception that stopped the pipeline
+        self._trails = deque(maxlen=history)
+        self._latest = None
+        self._snapshot = None
+        self._running = threading.Event()
+        self._send_lock = threading.Lock()  #Nothing is sent after the STOP of a failed analysis
+        self._threads = []
+
+    def start(self):
+        """Starts the capture, analysis and sender threads"""
+        self._running.set()
+        for target in (self._capture_loop, self._analysis_loop, self._send_loop):
+            thread = threading.Thread(target=target, daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self, timeout=2.0):
+        """Stops the threads and waits for them to finish"""
+        self._running.clear()
+        self.frames.close()
+        self.commands.close()
+        for thread in self._threads:
+            thread.join(timeout)
+        self._threads = []
+
+    @property
+    def running(self):
+        return self._running.is_set()
+
+    def latest(self):
+        """Returns (trail, frame, command) of the last analyzed frame, or None.
+        frame is the annotated frame when annotate is set, else None."""
+        return self._latest
+
+    def snapshot(self):
+        """Returns (trail, frame, result, command) of the last analyzed frame, or None.
+        The frame is the camera's, not a copy: readers must not draw on it."""
+        return self._snapshot
+
+    def trails(self):
+        """Returns the trails of the last frames, oldest first"""
+        return list(self._trails)
+
+    def analysis_rate(self):
+        """Returns the number of frames analyzed per second over the kept history"""
+        done = [trail.analyzed for trail in self._trails if trail.analyzed is not None]
+        if len(done) < 2 or done[-1] == done[0]:
+            return 0.0
+        return (len(done) - 1) / (done[-1] - done[0])
+
+    def _capture_loop(self):
+        seq = 0
+        try:
+            while self._running.is_set():
+                ok, frame = self.camera.read()
+                captured = getattr(self.camera, "timestamp", None)
+                if captured is None:
+                    captured = time.perf_counter()
+                if not ok:
+                    # The camera is gone or the recording ended
+                    break
+                seq += 1
+                self.frames.put((FrameTrail(seq, captured), frame))
+        except Exception as error:
+            logger.exception("Frame capture failed")
+            self.failure = error
+        finally:
+            self._running.clear()
+            self.frames.close()
+
+    def _analyze(self, trail, frame):
+        """Refreshes the tracker with the frame, returns the command decided for it"""
+        self.gaze.refresh(frame)
+        command = self.decide(self.gaze, trail.captured)
+        trail.analyzed = time.perf_counter()
+        trail.command = command
+        self._trails.append(trail)
+
+        self._snapshot = (trail, frame, self.gaze.result, command)
+        if self.bus is not None:
+            self.bus.publish(frame, self.gaze.result, trail.captured, command)
+        if self.annotate:
+            self._latest = (trail, self.gaze.annotated_frame(), command)
+        else:
+            self._latest = (trail, None, command)
+        return command
+
+    def _analysis_loop(self):
+        failures = 0  #In a row
+        try:
+            while self._running.is_set():
+                item = self.frames.get(timeout=0.5)
+                if item is None:
+                    continue
+                trail, frame = item
+                trail.analysis_start = time.perf_counter()
+                if self.max_frame_age is not None and trail.analysis_start - trail.captured > self.max_frame_age:
+                    self.skipped += 1
+                    continue
+
+                try:
+                    command = self._analyze(trail, frame)
+                except Exception:
+                    # A bad frame, e.g. an eye at the edge of the image: skip it
+                    self.errors += 1
+                    failures += 1
+                    if failures >= self.max_errors:
+                        raise
+                    logger.exception("Analysis of frame %d failed", trail.seq)
+                    continue
+                failures = 0
+                if command:
+                    self.commands.put(trail)
+        except Exception as error:
+            logger.exception("Analysis stopped after %d failed frames in a row", failures)
+            self.failure = error
+        finally:
+            self._running.clear()
+            self.frames.close()
+            self.commands.close()
+            if self.failure is not None:
+                # Nothing decides the commands anymore, the robot mustn't keep moving
+                with self._send_lock:
+                    try:
+                        self.send("STOP")
+                    except Exception:
+                        logger.exception("STOP couldn't be sent")
+
+    def _send_loop(self):
+        while self._running.is_set():
+            trail = self.commands.get(timeout=0.5)
+            if trail is None:
+                continue
+            with self._send_lock:
+                if not self._running.is_set():
+                    break
+                try:
+                    self.send(trail.command)
+                except Exception:
+                    logger.exception("Sending %s failed", trail.command)
+                    continue
+            trail.sent = time.perf_counter()
@@ -0,0 +1,234 @@
+"""
+Low-rate preview of the pipeline, for display and remote debugging. It
+runs on its own thread, at most `rate` times per second: it reads the last
+analyzed frame and result from Pipeline.snapshot(), draws on a downscaled
+copy, and hands the image to its sinks. The analysis thread never copies,
+draws or waits for a window.
+
+Sinks have a write(image) and a close() method:
+
+    FileSink("preview.jpg")        last image, replaced atomically
+    FileSink("preview.avi")        every preview image, Motion JPEG video
+    MjpegSink(8080)                http://127.0.0.1:8080/ in a browser
+"""
+from __future__ import division
+import os
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+import cv2
+
+
+def draw_pupils(frame, result, scale=1.0):
+    """Draws a cross on each pupil of the result, in place
+
+    Arguments:
+        frame (numpy.ndarray): Frame to draw on
+        result (GazeResult): Result of the analysis of the frame
+        scale (float): Size of the frame relative to the analyzed one
+    """
+    if not result.pupils_located:
+        return
+    color = (0, 255, 0)
+    size = max(2, int(round(5 * scale)))
+    for x, y in (result.pupil_left, result.pupil_right):
+        x, y = int(x * scale), int(y * scale)
+        cv2.line(frame, (x - size, y), (x + size, y), color)
+        cv2.line(frame, (x, y - size), (x, y + size), color)
+
+
+def render(frame, result, command=None, scale=0.5):
+    """Returns a downscaled copy of the frame with the pupils and the command drawn on it
+
+    Arguments:
+        frame (numpy.ndarray): Analyzed frame, left untouched
+        result (GazeResult): Result of its analysis
+        command (str): Command sent for the frame
+        scale (float): Size of the preview relative to the frame
+    """
+    if scale != 1.0:
+        image = cv2.resize(frame, None, fx=scale, fy=scale, interpolation=cv2.INTER_AREA)
+    else:
+        image = frame.copy()
+    if image.ndim == 2:
+        image = cv2.cvtColor(image, cv2.COLOR_GRAY2BGR)
+    draw_pupils(image, result, scale)
+    if command:
+        cv2.putText(image, command, (int(100 * scale), int(100 * scale)), cv2.FONT_HERSHEY_DUPLEX,
+                    1.6 * scale, (0, 0, 255), max(1, int(round(2 * scale))))
+    return image
+
+
+class FileSink(object):
+    """Writes the preview to an image file (replaced at every image) or to a video file"""
+
+    VIDEO_EXTENSIONS = (".avi", ".mkv", ".mp4")
+
+    def __init__(self, path, fps=5.0):
+        """
+        Arguments:
+            path (str): .jpg or .png for the last image only, .avi, .mkv or .mp4 for a video
+            fps (float): Frame rate written in the video
+        """
+        self.path = path
+        self.fps = fps
+        self._writer = None
+
+    def write(self, image):
+        if not self.path.lower().endswith(self.VIDEO_EXTENSIONS):
+            extension = os.path.splitext(self.path)[1] or ".jpg"
+            temporary = self.path + ".tmp" + extension
+            cv2.imwrite(temporary, image)
+            os.replace(temporary, self.path)   #Readers never see a half written image
+            return
+        if self._writer is None:
+            height, width = image.shape[:2]
+            self._writer = cv2.VideoWriter(self.path, cv2.VideoWriter_fourcc(*"MJPG"), self.fps, (width, height))
+        self._writer.write(image)
+
+    def close(self):
+        if self._writer is not None:
+            self._writer.release()
+            self._writer = None
+
+
+class MjpegSink(object):
+    """
+    Serves the preview as a Motion JPEG stream over HTTP, on localhost by
+    default. Each image is encoded once, whatever the number of viewers,
+    and a slow viewer only misses images.
+    """
+
+    def __init__(self, port=8080, host="127.0.0.1", quality=70):
+        """
+        Arguments:
+            port (int): HTTP port, 0 for any free port (see address)
+            host (str): Interface to listen on
+            quality (int): JPEG quality, 0 to 100
+        """
+        self.quality = quality
+        self._jpeg = None
+        self._count = 0
+        self._cond = threading.Condition()
+        self._closed = False
+
+        sink = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.send_header("Content-Type", "multipart/x-mixed-replace; boundary=frame")
+                self.send_header("Cache-Control", "no-cache")
+                self.end_headers()
+                seen = 0
+                try:
+                    while True:
+                        jpeg, seen = sink._wait(seen)
+                        if jpeg is None:
+                            return
+                        self.wfile.write(b"--frame\r\nContent-Type: image/jpeg\r\nContent-Length: "
+                                         + str(len(jpeg)).encode("ascii") + b"\r\n\r\n" + jpeg + b"\r\n")
+                except (IOError, OSError):
+                    return   #Viewer gone
+
+            def log_message(self, format, *args):
+                pass
+
+        class Server(ThreadingMixIn, HTTPServer):
+            daemon_threads = True
+
+        self._server = Server((host, port), Handler)
+        self.address = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, kwargs={"poll_interval": 0.5},
+                                        daemon=True)
+        self._thread.start()
+
+    def _wait(self, seen):
+        """Returns the next image after the seen one, (None, seen) once closed"""
+        with self._cond:
+            self._cond.wait_for(lambda: self._count != seen or self._closed)
+            if self._closed:
+                return None, seen
+            return self._jpeg, self._count
+
+    def write(self, image):
+        ok, jpeg = cv2.imencode(".jpg", image, [cv2.IMWRITE_JPEG_QUALITY, self.quality])
+        if not ok:
+            return
+        with self._cond:
+            self._jpeg = jpeg.tobytes()
+            self._count += 1
+            self._cond.notify_all()
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class Preview(object):
+    """
+    Renders the last analyzed frame of a Pipeline on a background thread,
+    at a capped rate. image() returns the last rendered image, e.g. for a
+    window shown by the main thread.
+    """
+
+    def __init__(self, pipeline, rate=5.0, scale=0.5, sinks=()):
+        """
+        Arguments:
+            pipeline (Pipeline): Pipeline to preview
+            rate (float): Maximum number of images per second
+            scale (float): Size of the preview relative to the camera frames
+            sinks (list): Where to write each image, e.g. FileSink or MjpegSink
+        """
+        self.pipeline = pipeline
+        self.rate = rate
+        self.scale = scale
+        self.sinks = list(sinks)
+        self.rendered = 0
+        self._image = None
+        self._running = threading.Event()
+        self._thread = None
+
+    def start(self):
+        self._running.set()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def stop(self, timeout=2.0):
+        """Stops the thread and closes the sinks"""
+        self._running.clear()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+        for sink in self.sinks:
+            sink.close()
+
+    def image(self):
+        """Returns the last rendered image, or None"""
+        return self._image
+
+    def _loop(self):
+        shown_seq = None
+        period = 1 / self.rate
+        next_time = time.perf_counter()
+        while self._running.is_set():
+            snapshot = self.pipeline.snapshot()
+            if snapshot is not None and snapshot[0].seq != shown_seq:
+                trail, frame, result, command = snapshot
+                shown_seq = trail.seq
+                image = render(frame, result, command, self.scale)
+                self._image = image
+                self.rendered += 1
+                for sink in self.sinks:
+                    sink.write(image)
+
+            next_time += period
+            delay = next_time - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            else:
+                next_time = time.perf_counter()   #Late: don't try to catch up
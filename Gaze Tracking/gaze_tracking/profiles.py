@@ -0,0 +1,185 @@
+"""
+Calibration profiles. The thresholds found by Calibration are saved per
+user and per camera, so the next session starts calibrated on its first
+frame. Loaded thresholds are checked against the first frames of the
+session and the calibration starts over if they don't fit the lighting
+anymore (see Calibration.load).
+
+    python -m gaze_tracking.profiles list
+    python -m gaze_tracking.profiles show USER CAMERA
+    python -m gaze_tracking.profiles reset USER CAMERA
+    python -m gaze_tracking.profiles reset --all
+"""
+from __future__ import division
+import argparse
+import json
+import os
+import re
+import time
+
+DEFAULT_DIRECTORY = os.environ.get("GAZE_PROFILES",
+                                   os.path.join(os.path.expanduser("~"), ".gaze_tracking", "profiles"))
+VERSION = 1
+
+
+def camera_key(camera, mode=None):
+    """Returns the name identifying a camera in the profiles
+
+    Arguments:
+        camera (Camera): Camera from camera.available_cameras()
+        mode (tuple): (width, height, fps) the camera is used in
+    """
+    key = camera.name
+    if mode is not None:
+        key += " {}x{}".format(mode[0], mode[1])
+    return key
+
+
+def _slug(text):
+    return re.sub(r"[^A-Za-z0-9_.-]+", "_", text).strip("_") or "_"
+
+
+class ProfileStore(object):
+    """
+    Directory of calibration profiles, one JSON file per user and camera.
+    """
+
+    def __init__(self, directory=None):
+        """
+        Arguments:
+            directory (str): Where the profiles are, $GAZE_PROFILES or ~/.gaze_tracking/profiles by default
+        """
+        self.directory = directory or DEFAULT_DIRECTORY
+
+    def path(self, user, camera):
+        """Returns the file of the profile of a user and a camera"""
+        return os.path.join(self.directory, "{}--{}.json".format(_slug(user), _slug(camera)))
+
+    def load(self, user, camera):
+        """Returns the profile of a user and a camera as a dict, or None if there is none or it can't be read"""
+        try:
+            with open(self.path(user, camera)) as file:
+                profile = json.load(file)
+        except (IOError, OSError, ValueError):
+            return None
+        if profile.get("version") != VERSION or not profile.get("thresholds_left") \
+                or not profile.get("thresholds_right"):
+            return None
+        return profile
+
+    def save(self, user, camera, calibration):
+        """Saves the thresholds of a complete calibration, returns the path of the profile
+
+        Arguments:
+            user (str): Name of the user
+            camera (str): Name of the camera, see camera_key()
+            calibration (Calibration): Complete calibration
+        """
+        if not calibration.is_complete():
+            raise ValueError("calibration is not complete")
+        profile = {
+            "version": VERSION,
+            "user": user,
+            "camera": camera,
+            "saved": time.time(),
+            "threshold_step": calibration.threshold_step,
+            "thresholds_left": list(calibration.thresholds_left),
+            "thresholds_right": list(calibration.thresholds_right),
+            "threshold_left": calibration.threshold(0),
+            "threshold_right": calibration.threshold(1),
+        }
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        path = self.path(user, camera)
+        temporary = path + ".tmp"
+        with open(temporary, "w") as file:
+            json.dump(profile, file, indent=2)
+        os.replace(temporary, path)   #A crash while saving never leaves a truncated profile
+        return path
+
+    def apply(self, user, camera, calibration, verify_frames=5, tolerance=15):
+        """Loads the profile of a user and a camera into a calibration.
+        Returns true if there was one.
+
+        Arguments:
+            user (str): Name of the user
+            camera (str): Name of the camera, see camera_key()
+            calibration (Calibration): Calibration to load the thresholds into
+            verify_frames (int): Frames of each eye checked against the thresholds
+            tolerance (int): Largest accepted difference with the best threshold of a frame
+        """
+        profile = self.load(user, camera)
+        if profile is None:
+            return False
+        calibration.load(profile["thresholds_left"], profile["thresholds_right"], verify_frames, tolerance)
+        return True
+
+    def delete(self, user, camera):
+        """Removes the profile of a user and a camera, returns true if there was one"""
+        try:
+            os.remove(self.path(user, camera))
+            return True
+        except OSError:
+            return False
+
+    def profiles(self):
+        """Returns every readable profile, sorted by user and camera"""
+        if not os.path.isdir(self.directory):
+            return []
+        found = []
+        for name in sorted(os.listdir(self.directory)):
+            if not name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.directory, name)) as file:
+                    found.append(json.load(file))
+            except (IOError, OSError, ValueError):
+                continue
+        return sorted(found, key=lambda profile: (profile.get("user"), profile.get("camera")))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Inspect or reset the calibration profiles")
+    parser.add_argument("-d", "--directory", help="Profiles directory, $GAZE_PROFILES or ~/.gaze_tracking/profiles")
+    commands = parser.add_subparsers(dest="command")
+    commands.add_parser("list", help="List the profiles")
+    show = commands.add_parser("show", help="Print a profile")
+    show.add_argument("user")
+    show.add_argument("camera")
+    reset = commands.add_parser("reset", help="Delete a profile, the next session calibrates again")
+    reset.add_argument("user", nargs="?")
+    reset.add_argument("camera", nargs="?")
+    reset.add_argument("--all", action="store_true", help="Delete every profile")
+    args = parser.parse_args()
+
+    store = ProfileStore(args.directory)
+    if args.command == "show":
+        profile = store.load(args.user, args.camera)
+        if profile is None:
+            raise SystemExit("No profile for {} on {}".format(args.user, args.camera))
+        print(json.dumps(profile, indent=2))
+    elif args.command == "reset":
+        if args.all:
+            targets = [(profile.get("user"), profile.get("camera")) for profile in store.profiles()]
+        elif args.user and args.camera:
+            targets = [(args.user, args.camera)]
+        else:
+            parser.error("reset needs USER and CAMERA, or --all")
+        for user, camera in targets:
+            if store.delete(user, camera):
+                print("Deleted {} on {}".format(user, camera))
+            else:
+                print("No profile for {} on {}".format(user, camera))
+    else:
+        profiles = store.profiles()
+        if not profiles:
+            print("No profiles in {}".format(store.directory))
+        for profile in profiles:
+            saved = time.strftime("%Y-%m-%d %H:%M", time.localtime(profile.get("saved", 0)))
+            print("{}  {}  left {}  right {}  saved {}".format(profile.get("user"), profile.get("camera"),
+                                                               profile.get("threshold_left"),
+                                                               profile.get("threshold_right"), saved))
+
+
+if __name__ == "__main__":
+    main()
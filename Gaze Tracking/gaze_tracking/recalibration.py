@@ -0,0 +1,162 @@
+from __future__ import division
+import logging
+import queue
+import threading
+import time
+import cv2
+import numpy as np
+from .calibration import Calibration
+
+logger = logging.getLogger(__name__)
+
+
+def eye_brightness(eye):
+    """Returns the mean brightness of the pixels inside the eye polygon, or None if
+    there are none. The rest of Eye.frame is the white fill of the mask, which
+    doesn't change with the lighting.
+
+    Arguments:
+        eye (Eye): Analyzed eye
+    """
+    mask = np.zeros(eye.frame.shape[:2], np.uint8)
+    cv2.fillPoly(mask, [eye.landmark_points], 255, offset=(-eye.origin[0], -eye.origin[1]))
+    if not cv2.countNonZero(mask):
+        return None
+    return cv2.mean(eye.frame, mask)[0]
+
+
+class Recalibrator(object):
+    """
+    Keeps a complete Calibration in line with the lighting. The mean
+    brightness of the eye patches is followed on every frame (a few
+    microseconds); when it drifts away from the brightness the thresholds
+    were found in, eye frames are sampled for a while and the threshold
+    search runs on them in a background thread. The results go into the
+    rolling windows of the calibration with Calibration.swap(), the frame
+    loop never waits for the search.
+    """
+
+    def __init__(self, calibration, drift=20.0, smoothing=0.05, sample_every=3, samples=20):
+        """
+        Arguments:
+            calibration (Calibration): Calibration to keep up to date
+            drift (float): Change of the mean eye brightness (gray levels) that starts a recalibration
+            smoothing (float): Weight of the last frame in the averaged brightness,
+                low enough for blinks not to count as a lighting change
+            sample_every (int): One eye frame out of that many is sampled
+            samples (int): Eye frames of each eye the search runs on
+        """
+        self.calibration = calibration
+        self.drift = drift
+        self.smoothing = smoothing
+        self.sample_every = sample_every
+        self.samples = samples
+
+        self.brightness = None   #Averaged mean brightness inside the eye polygons
+        self.reference = None    #Brightness the thresholds in use were found in
+        self._sampled = None     #([left frames], [right frames]) while sampling
+        self._frames_seen = 0
+        self._busy = False
+
+        self._jobs = queue.Queue()
+        self._thread = None
+
+        self.recalibrations = 0
+        self.failures = 0  #Searches that raised, the next drift check starts another one
+        self.last_duration = None
+
+    def observe(self, eye_left, eye_right):
+        """Follows the lighting on the eyes of a new frame, called once per analyzed frame
+
+        Arguments:
+            eye_left (Eye): Left eye of the frame
+            eye_right (Eye): Right eye of the frame
+        """
+        calibration = self.calibration
+        if not calibration.is_complete() or calibration.is_verifying():
+            # The inline calibration or the check of a loaded profile sets the reference
+            self.reference = None
+            self._sampled = None
+            return
+
+        left, right = eye_brightness(eye_left), eye_brightness(eye_right)
+        if left is None or right is None:
+            return
+        brightness = (left + right) / 2
+        if self.brightness is None:
+            self.brightness = brightness
+        else:
+            self.brightness += self.smoothing * (brightness - self.brightness)
+        if self.reference is None:
+            self.reference = self.brightness
+            return
+        if self._busy:
+            return
+
+        if self._sampled is None:
+            if abs(self.brightness - self.reference) > self.drift:
+                self._sampled = ([], [])
+                self._frames_seen = 0
+            return
+
+        self._frames_seen += 1
+        if self._frames_seen % self.sample_every:
+            return
+        # Copies: the search runs on another thread while the next frames are analyzed
+        self._sampled[0].append(eye_left.frame.copy())
+        self._sampled[1].append(eye_right.frame.copy())
+        if len(self._sampled[0]) >= self.samples:
+            self._submit(self._sampled)
+            self._sampled = None
+
+    def _submit(self, sampled):
+        self._busy = True
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._work, daemon=True)
+            self._thread.start()
+        self._jobs.put(sampled)
+
+    def _work(self):
+        while True:
+            sampled = self._jobs.get()
+            if sampled is None:
+                return
+            start = time.perf_counter()
+            step = self.calibration.threshold_step
+            try:
+                thresholds = [[Calibration.find_best_threshold(frame, step) for frame in frames
+                               if frame.shape[0] > 10 and frame.shape[1] > 10]
+                              for frames in sampled]
+                if thresholds[0] and thresholds[1]:
+                    self.calibration.swap(thresholds[0], thresholds[1])
+                    self.recalibrations += 1
+                self.reference = self.brightness
+            except Exception:
+                # The worker stays alive, the thresholds in use are kept until the next search
+                self.failures += 1
+                logger.exception("Recalibration failed")
+            finally:
+                self.last_duration = time.perf_counter() - start
+                self._busy = False
+
+    def is_recalibrating(self):
+        """Returns true while eye frames are sampled or searched for new thresholds"""
+        return self._busy or self._sampled is not None
+
+    def close(self):
+        """Stops the background thread"""
+        if self._thread is not None:
+            self._jobs.put(None)
+            self._thread.join(1.0)
+            self._thread = None
+
+    def stats(self):
+        """Returns the lighting and the number of recalibrations"""
+        return {
+            "brightness": self.brightness,
+            "reference": self.reference,
+            "recalibrating": self.is_recalibrating(),
+            "recalibrations": self.recalibrations,
+            "failures": self.failures,
+            "last_duration": self.last_duration,
+        }
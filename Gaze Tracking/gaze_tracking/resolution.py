@@ -0,0 +1,106 @@
+from __future__ import division
+
+
+class ResolutionController(object):
+    """
+    Adapts the resolutions GazeTracking works at to a latency budget per
+    frame. The face detector and the eye analysis have their own scale
+    (GazeTracking.detection_scale and eye_scale): each one goes down while
+    its stage takes more than its share of the budget and back up when there
+    is time left, but never below what the face size needs, so a user
+    sitting far away keeps enough pixels for the detector and the pupils.
+
+    It wraps the tracker and can be used in its place: refresh() adapts the
+    scales after each frame and every other attribute is the tracker's.
+    """
+
+    def __init__(self, gaze, target_latency=0.05, min_scale=0.25, max_scale=1.0,
+                 min_face_width=80, min_eye_width=30, step=0.1, smoothing=0.2):
+        """
+        Arguments:
+            gaze (GazeTracking): Tracker to control
+            target_latency (float): Budget per frame, in seconds
+            min_scale (float): Lowest scale allowed
+            max_scale (float): Highest scale allowed
+            min_face_width (int): Width in pixels the face must keep for the detector
+            min_eye_width (int): Width in pixels an eye must keep for the pupil detection
+            step (float): Relative change of a scale per frame
+            smoothing (float): Weight of the last frame in the averaged timings
+        """
+        self.gaze = gaze
+        self.target_latency = target_latency
+        self.min_scale = min_scale
+        self.max_scale = max_scale
+        self.min_face_width = min_face_width
+        self.min_eye_width = min_eye_width
+        self.step = step
+        self.smoothing = smoothing
+
+        self.latency = None  #Last frame
+        self.average_latency = None
+        self.average_detect = None
+        self.average_eyes = None
+
+    def __getattr__(self, name):
+        return getattr(self.gaze, name)
+
+    def _average(self, average, value):
+        if average is None:
+            return value
+        return average + self.smoothing * (value - average)
+
+    def _adjust(self, scale, stage_time, floor):
+        """Returns the next scale of a stage given its averaged time and the lowest scale it may use"""
+        if stage_time > 0.5 * self.target_latency:
+            scale *= 1 - self.step
+        elif stage_time < 0.25 * self.target_latency:
+            scale *= 1 + self.step
+        scale = float(min(max(scale, floor, self.min_scale), self.max_scale))
+        return 1.0 if scale >= 0.98 else scale
+
+    def refresh(self, frame):
+        """Analyzes the frame, then adapts the scales for the next one
+
+        Arguments:
+            frame (numpy.ndarray): The frame to analyze
+        """
+        gaze = self.gaze
+        gaze.refresh(frame)
+
+        self.latency = gaze.frame_time
+        self.average_latency = self._average(self.average_latency, gaze.frame_time)
+        if gaze.reused:
+            return
+
+        if gaze.detect_time is not None:
+            self.average_detect = self._average(self.average_detect, gaze.detect_time)
+        if gaze.eye_time is not None:
+            self.average_eyes = self._average(self.average_eyes, gaze.eye_time)
+
+        if gaze.eye_left is None:
+            # Face lost: a bigger detection scale finds smaller faces
+            gaze.detection_scale = min(gaze.detection_scale * (1 + self.step), self.max_scale)
+            return
+
+        # Sizes at full resolution, the landmarks always are
+        face_width = gaze._face_box.width() if gaze._face_box is not None else None
+        if self.average_detect is not None and face_width:
+            gaze.detection_scale = self._adjust(gaze.detection_scale, self.average_detect,
+                                                self.min_face_width / face_width)
+
+        eye_points = gaze.eye_left.landmark_points
+        eye_width = (eye_points[:, 0].max() - eye_points[:, 0].min()) / gaze.eye_scale
+        if self.average_eyes is not None and eye_width > 0:
+            gaze.eye_scale = self._adjust(gaze.eye_scale, self.average_eyes, self.min_eye_width / eye_width)
+
+    def report(self):
+        """Returns the chosen scales and the achieved latency"""
+        return {
+            "detection_scale": self.gaze.detection_scale,
+            "eye_scale": self.gaze.eye_scale,
+            "target_latency": self.target_latency,
+            "latency": self.latency,
+            "average_latency": self.average_latency,
+            "average_detect": self.average_detect,
+            "average_eyes": self.average_eyes,
+        }
@@ -0,0 +1,150 @@
+from __future__ import division
+import numpy as np
+from .eye import Eye
+
+RIGHT = "right"
+LEFT = "left"
+CENTER = "center"
+DIRECTIONS = (None, CENTER, LEFT, RIGHT)  #Position in the tuple is the code stored in RESULT_DTYPE
+
+RESULT_DTYPE = np.dtype([
+    ("face_found", np.bool_),
+    ("pupils_located", np.bool_),
+    ("pupil_left_x", np.float64),
+    ("pupil_left_y", np.float64),
+    ("pupil_right_x", np.float64),
+    ("pupil_right_y", np.float64),
+    ("horizontal_ratio", np.float64),
+    ("vertical_ratio", np.float64),
+    ("blink_ratio", np.float64),
+    ("blinking", np.bool_),
+    ("direction", np.int8),
+])
+
+
+class GazeResult(object):
+    """
+    Immutable result of the analysis of one frame. Every derived value is
+    computed once, when the result is built, and the accessors of
+    GazeTracking only read it. Missing values are None.
+    """
+
+    RIGHT_LIMIT = 0.35   #horizontal_ratio at or below this value means looking right
+    LEFT_LIMIT = 0.65    #horizontal_ratio at or above this value means looking left
+    BLINK_LIMIT = 3.8    #blink_ratio above this value means the eyes are closed
+
+    __slots__ = ("face_found", "pupils_located", "pupil_left", "pupil_right",
+                 "horizontal_ratio", "vertical_ratio", "blink_ratio", "blinking", "direction")
+
+    def __init__(self, face_found=False, pupils_located=False, pupil_left=None, pupil_right=None,
+                 horizontal_ratio=None, vertical_ratio=None, blink_ratio=None, blinking=None, direction=None):
+        set_value = object.__setattr__
+        set_value(self, "face_found", face_found)
+        set_value(self, "pupils_located", pupils_located)
+        set_value(self, "pupil_left", pupil_left)
+        set_value(self, "pupil_right", pupil_right)
+        set_value(self, "horizontal_ratio", horizontal_ratio)
+        set_value(self, "vertical_ratio", vertical_ratio)
+        set_value(self, "blink_ratio", blink_ratio)
+        set_value(self, "blinking", blinking)
+        set_value(self, "direction", direction)
+
+    def __setattr__(self, name, value):
+        raise AttributeError("GazeResult is immutable")
+
+    def __repr__(self):
+        values = ", ".join("{}={!r}".format(name, getattr(self, name)) for name in self.__slots__)
+        return "GazeResult({})".format(values)
+
+    @staticmethod
+    def _ratio(pupil, center, scale):
+        """Returns the position of the pupil in the eye on one axis, as the
+        original formula pupil / (eye size - 2 margins) gives it on a full
+        resolution frame. The margin of Eye is in analyzed pixels, so at a
+        lower eye scale it is converted to full resolution pixels first,
+        otherwise the ratio would shift with the scale.
+
+        Arguments:
+            pupil (float): Pupil coordinate in the eye frame
+            center (float): Center coordinate of the eye frame
+            scale (float): Scale the eye was analyzed at
+        """
+        return (pupil - Eye.MARGIN * (1 - scale)) / (center * 2 - 2 * Eye.MARGIN)
+
+    @classmethod
+    def from_eyes(cls, eye_left, eye_right, transform=None):
+        """Computes the result from the eyes of a frame
+
+        Arguments:
+            eye_left (Eye): Left eye, None when no face was found
+            eye_right (Eye): Right eye, None when no face was found
+            transform (tuple): (x, y, scale) of the region the eyes were analyzed in,
+                None when they were analyzed in the full frame
+        """
+        if eye_left is None or eye_right is None:
+            return cls()
+
+        blink_ratio = None
+        if eye_left.blinking is not None and eye_right.blinking is not None:
+            blink_ratio = (eye_left.blinking + eye_right.blinking) / 2
+
+        located = all(value is not None for value in (eye_left.pupil.x, eye_left.pupil.y,
+                                                      eye_right.pupil.x, eye_right.pupil.y))
+        if not located:
+            return cls(face_found=True, blink_ratio=blink_ratio)
+
+        pupil_left = (eye_left.origin[0] + eye_left.pupil.x, eye_left.origin[1] + eye_left.pupil.y)
+        pupil_right = (eye_right.origin[0] + eye_right.pupil.x, eye_right.origin[1] + eye_right.pupil.y)
+        if transform is not None:
+            #Back to the coordinates of the full frame
+            x, y, scale = transform
+            pupil_left = (x + pupil_left[0] / scale, y + pupil_left[1] / scale)
+            pupil_right = (x + pupil_right[0] / scale, y + pupil_right[1] / scale)
+
+        scale = transform[2] if transform is not None else 1.0
+        try:
+            horizontal = (cls._ratio(eye_left.pupil.x, eye_left.center[0], scale)
+                          + cls._ratio(eye_right.pupil.x, eye_right.center[0], scale)) / 2
+        except ZeroDivisionError:
+            horizontal = None
+        try:
+            vertical = (cls._ratio(eye_left.pupil.y, eye_left.center[1], scale)
+                        + cls._ratio(eye_right.pupil.y, eye_right.center[1], scale)) / 2
+        except ZeroDivisionError:
+            vertical = None
+
+        direction = None
+        if horizontal is not None:
+            if horizontal <= cls.RIGHT_LIMIT:
+                direction = RIGHT
+            elif horizontal >= cls.LEFT_LIMIT:
+                direction = LEFT
+            else:
+                direction = CENTER
+
+        blinking = blink_ratio > cls.BLINK_LIMIT if blink_ratio is not None else None
+
+        return cls(True, True, pupil_left, pupil_right, horizontal, vertical, blink_ratio, blinking, direction)
+
+    def as_record(self):
+        """Returns the result as a tuple matching RESULT_DTYPE, missing values are NaN"""
+        nan = float("nan")
+        left = self.pupil_left or (nan, nan)
+        right = self.pupil_right or (nan, nan)
+        return (self.face_found, self.pupils_located, left[0], left[1], right[0], right[1],
+                nan if self.horizontal_ratio is None else self.horizontal_ratio,
+                nan if self.vertical_ratio is None else self.vertical_ratio,
+                nan if self.blink_ratio is None else self.blink_ratio,
+                bool(self.blinking), DIRECTIONS.index(self.direction))
+
+    @staticmethod
+    def stack(results):
+        """Returns a structured array (RESULT_DTYPE) with one row per result
+
+        Arguments:
+            results: Iterable of GazeResult
+        """
+        return np.array([result.as_record() for result in results], dtype=RESULT_DTYPE)
+
+
+EMPTY_RESULT = GazeResult()
@@ -0,0 +1,117 @@
+"""
+Frame sources for Pipeline. A source has the read() -> (ok, frame) and
+release() methods of cv2.VideoCapture, plus a `timestamp` attribute: the
+time.perf_counter() at which the last frame read was captured. Pipeline
+uses it as the start of the frame's latency.
+
+The command side needs no interface of its own, CommandChannel writes to
+any object with a write(bytes) method: serial.Serial for the Arduino, or
+command_channel.MemoryTransport to record what arrives and when.
+"""
+from __future__ import division
+import time
+import cv2
+
+
+class CameraSource(object):
+    """A live camera. Frames are timestamped when read() returns, so the
+    exposure and the USB transfer aren't part of the measured latency."""
+
+    def __init__(self, index, width=None, height=None):
+        """
+        Arguments:
+            index (int): Index of the camera for cv2.VideoCapture
+            width (int): Requested frame width
+            height (int): Requested frame height
+        """
+        self.capture = cv2.VideoCapture(index)
+        if width is not None and height is not None:
+            self.capture.set(cv2.CAP_PROP_FRAME_WIDTH, width)
+            self.capture.set(cv2.CAP_PROP_FRAME_HEIGHT, height)
+        self.timestamp = None
+
+    def isOpened(self):
+        return self.capture.isOpened()
+
+    def read(self):
+        ok, frame = self.capture.read()
+        self.timestamp = time.perf_counter()
+        return ok, frame
+
+    def release(self):
+        self.capture.release()
+
+
+class ReplayCamera(object):
+    """
+    Plays frames held in memory at a fixed rate, like a camera would: frame
+    i is captured at start + i / fps, read() waits for it, and frames whose
+    time went by while nobody was reading are lost. Decoding happens before
+    the replay, so it doesn't count in the latency.
+    """
+
+    def __init__(self, frames, fps=30.0, loop=False):
+        """
+        Arguments:
+            frames (list): Frames to play
+            fps (float): Frames per second
+            loop (bool): Starts over at the end instead of stopping
+        """
+        self.frames = list(frames)
+        if not self.frames:
+            raise ValueError("no frames to replay")
+        self.fps = fps
+        self.loop = loop
+        self.timestamp = None
+        self.emitted = 0
+        self.dropped = 0  #Frames captured while the reader was busy, never read
+        self._start = None
+        self._index = 0
+
+    @classmethod
+    def from_path(cls, path, fps=None, max_frames=None, loop=False):
+        """Loads the frames of a video or of a directory of images
+
+        Arguments:
+            path (str): Video file or directory of images
+            fps (float): Frames per second, the rate of the video (or 30) by default
+            max_frames (int): Number of frames to load, all of them by default
+            loop (bool): Starts over at the end instead of stopping
+        """
+        from .batch import FrameSource
+        source = FrameSource(path)
+        stop = source.length if max_frames is None else min(max_frames, source.length)
+        frames = [frame for _, frame in source.frames(0, stop) if frame is not None]
+        if fps is None and source.images is None:
+            capture = cv2.VideoCapture(path)
+            fps = capture.get(cv2.CAP_PROP_FPS) or None
+            capture.release()
+        return cls(frames, fps or 30.0, loop)
+
+    def isOpened(self):
+        return True
+
+    def read(self):
+        now = time.perf_counter()
+        if self._start is None:
+            self._start = now
+        due = int((now - self._start) * self.fps)
+        if due > self._index:
+            if not self.loop:
+                due = min(due, len(self.frames))
+            self.dropped += due - self._index
+            self._index = due
+        if self._index >= len(self.frames) and not self.loop:
+            return False, None
+
+        timestamp = self._start + self._index / self.fps
+        if timestamp > now:
+            time.sleep(timestamp - now)
+        frame = self.frames[self._index % len(self.frames)]
+        self._index += 1
+        self.emitted += 1
+        self.timestamp = timestamp
+        return True, frame
+
+    def release(self):
+        pass
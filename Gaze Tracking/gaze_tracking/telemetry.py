@@ -0,0 +1,435 @@
+"""
+Per-frame telemetry log for incident review. Every analyzed frame is
+appended as one fixed size record (TELEMETRY_DTYPE) to a memory-mapped
+file: a write is a copy into the mapping, no system call, no formatting.
+Files are grown by chunks of records and a new file is started when one
+reaches its maximum size.
+
+File layout: a 64 bytes header (magic, version, record size, number of
+records, flags), then the records. The header count is updated after each
+record, so a log cut by a crash or a power loss is read up to the last
+complete record.
+
+TelemetryReader maps the files read-only as NumPy structured arrays
+without loading them, and slices them by time or by event:
+
+    python -m gaze_tracking.telemetry logs/ --summary
+    python -m gaze_tracking.telemetry logs/ --no-face --from 2026-10-17T14:00 --to 2026-10-17T15:00
+    python -m gaze_tracking.telemetry logs/ --stops
+"""
+from __future__ import division
+import argparse
+import errno
+import glob
+import logging
+import os
+import sys
+import time
+import numpy as np
+from .bus import COMMANDS
+from .result import RESULT_DTYPE
+
+TELEMETRY_DTYPE = np.dtype([
+    ("seq", np.int64),
+    ("time", np.float64),          #Wall clock (time.time()) when the record was written
+    ("captured", np.float64),      #time.perf_counter() of the frame capture
+    ("command", np.int8),          #Code of the command decided for the frame, see bus.COMMANDS
+    ("changed", np.bool_),         #The command differs from the previous frame's
+    ("reused", np.bool_),          #The motion gate reused the previous eyes
+    ("frame_time", np.float32),    #Time spent in GazeTracking.refresh
+    ("detect_time", np.float32),   #Time spent in the face detector, NaN when it didn't run
+    ("decision_latency", np.float32),  #From capture to the command decision
+    ("detection_scale", np.float32),
+    ("eye_scale", np.float32),
+] + RESULT_DTYPE.descr)
+
+MAGIC = b"GAZETLM1"
+VERSION = 1
+HEADER_SIZE = 64
+EXTENSION = ".tlm"
+
+UNORDERED = 1   #Header flag: the clock went back while the file was written, its times aren't sorted
+
+_HEADER_DTYPE = np.dtype([("magic", "S8"), ("version", np.uint32), ("record_size", np.uint32),
+                          ("count", np.uint64), ("flags", np.uint32)])
+
+logger = logging.getLogger(__name__)
+
+
+def _reserve(file, start, length):
+    """Allocates the disk space of a part of the file now, so that a full disk is an
+    OSError here instead of a SIGBUS on the first write to a mapped page"""
+    try:
+        os.posix_fallocate(file.fileno(), start, length)
+        return
+    except AttributeError:   #Not on this system
+        pass
+    except OSError as error:
+        if error.errno not in (errno.EINVAL, errno.EOPNOTSUPP):   #File system without fallocate
+            raise
+    file.seek(start)
+    zeros = bytes(1 << 20)
+    while length > 0:
+        file.write(zeros[:min(length, len(zeros))])
+        length -= len(zeros)
+    file.flush()
+
+
+class TelemetryLog(object):
+    """
+    Append-only writer. It isn't thread-safe: write from one thread, e.g.
+    the analysis thread of the Pipeline. The disk space of each chunk is
+    reserved before it is mapped: when the disk is full, log_frame() logs
+    the error and turns the log off, the frame loop goes on.
+    """
+
+    def __init__(self, directory, prefix="telemetry", chunk_records=65536, max_bytes=1 << 30):
+        """
+        Arguments:
+            directory (str): Where the log files are created
+            prefix (str): Start of the file names
+            chunk_records (int): Number of records the file grows by at once
+            max_bytes (int): Size at which a new file is started
+        """
+        self.directory = directory
+        self.prefix = prefix
+        self.chunk_records = chunk_records
+        self.max_records = max(int((max_bytes - HEADER_SIZE) // TELEMETRY_DTYPE.itemsize), chunk_records)
+        self.seq = 0
+        self.path = None
+        self.files = 0
+        self._header = None
+        self._header_count = None
+        self._records = None
+        self._count = 0
+        self._last_command = None
+        self._last_time = -np.inf
+        self.failure = None  #OSError that turned the log off
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def _map(self, capacity):
+        self._header = np.memmap(self.path, _HEADER_DTYPE, "r+", shape=(1,))
+        self._header_count = self._header["count"]
+        self._header_flags = self._header["flags"]
+        self._records = np.memmap(self.path, TELEMETRY_DTYPE, "r+", offset=HEADER_SIZE, shape=(capacity,))
+
+    def _open(self):
+        self.files += 1
+        name = "{}-{}-{:04d}{}".format(self.prefix, time.strftime("%Y%m%d-%H%M%S"), self.files, EXTENSION)
+        self.path = os.path.join(self.directory, name)
+        size = HEADER_SIZE + self.chunk_records * TELEMETRY_DTYPE.itemsize
+        try:
+            with open(self.path, "wb") as file:
+                _reserve(file, 0, size)
+                file.truncate(size)
+        except OSError:
+            os.remove(self.path)   #Readers would take the empty file for a broken log
+            raise
+        self._count = 0
+        self._last_time = -np.inf
+        self._map(self.chunk_records)
+        self._header[0] = (MAGIC, VERSION, TELEMETRY_DTYPE.itemsize, 0, 0)
+
+    def _grow(self):
+        size = HEADER_SIZE + len(self._records) * TELEMETRY_DTYPE.itemsize
+        capacity = min(len(self._records) + self.chunk_records, self.max_records)
+        with open(self.path, "r+b") as file:
+            # Reserved while the current chunk is still mapped: on failure the log stays as it was
+            _reserve(file, size, HEADER_SIZE + capacity * TELEMETRY_DTYPE.itemsize - size)
+        self._unmap()
+        self._map(capacity)
+
+    def _unmap(self):
+        self._records.flush()
+        self._header.flush()
+        self._records = self._header = self._header_count = None
+
+    def _finish(self):
+        """Cuts the unused end of the current file"""
+        self._unmap()
+        with open(self.path, "r+b") as file:
+            file.truncate(HEADER_SIZE + self._count * TELEMETRY_DTYPE.itemsize)
+
+    def write(self, values):
+        """Appends a record
+
+        Arguments:
+            values (tuple): Values of the fields of TELEMETRY_DTYPE, in order
+        """
+        if self._records is None:
+            self._open()
+        elif self._count == len(self._records):
+            if self._count >= self.max_records:
+                self._finish()
+                self._open()
+            else:
+                self._grow()
+        if values[1] < self._last_time:   #The wall clock was set back, e.g. by NTP
+            self._header_flags[0] |= UNORDERED
+        self._last_time = values[1]
+        self._records[self._count] = values
+        self._count += 1
+        self._header_count[0] = self._count   #Last, the record is complete
+
+    def log_frame(self, gaze, captured, command=""):
+        """Appends the record of the last frame analyzed by a tracker
+
+        Arguments:
+            gaze (GazeTracking): Tracker, after refresh()
+            captured (float): time.perf_counter() of the frame capture
+            command (str): Command decided for the frame
+        """
+        if self.failure is not None:
+            return
+        nan = float("nan")
+        command = command or ""
+        self.seq += 1
+        try:
+            self.write((self.seq, time.time(), captured, COMMANDS.index(command), command != self._last_command,
+                        gaze.reused, gaze.frame_time if gaze.frame_time is not None else nan,
+                        gaze.detect_time if gaze.detect_time is not None else nan,
+                        time.perf_counter() - captured, gaze.detection_scale, gaze.eye_scale)
+                       + gaze.result.as_record())
+        except OSError as error:
+            # Disk full or gone: the telemetry stops, the control loop must not
+            logger.exception("Telemetry turned off, %s can't grow", self.path)
+            self.failure = error
+            self.close()
+            return
+        self._last_command = command
+
+    def flush(self):
+        """Asks the system to write the mapped pages to disk"""
+        if self._records is not None:
+            self._records.flush()
+            self._header.flush()
+
+    def close(self):
+        if self._records is not None:
+            self._finish()
+
+
+class TelemetryReader(object):
+    """
+    Reads the log files of a directory (or a single file), in time order.
+    Files are mapped when first used and only the pages that are read are
+    loaded, so multi-gigabyte logs open instantly.
+    """
+
+    def __init__(self, path):
+        """
+        Arguments:
+            path (str): Log file, or directory of log files
+        """
+        if os.path.isdir(path):
+            self.paths = sorted(glob.glob(os.path.join(path, "*" + EXTENSION)))
+        else:
+            self.paths = [path]
+        self._segments = {}
+        self._unordered = set()   #Indices of the files whose times aren't sorted
+
+    def segment(self, index):
+        """Returns the records of one file as a read-only memory-mapped structured array"""
+        if index not in self._segments:
+            path = self.paths[index]
+            header = np.fromfile(path, _HEADER_DTYPE, count=1)
+            if len(header) == 0 or header[0]["magic"] != MAGIC:
+                raise ValueError("{} isn't a telemetry log".format(path))
+            if header[0]["version"] != VERSION or header[0]["record_size"] != TELEMETRY_DTYPE.itemsize:
+                raise ValueError("{} was written by another version".format(path))
+            # The header count may be behind the file size (chunks) but never ahead of the records
+            if header[0]["flags"] & UNORDERED:
+                self._unordered.add(index)
+            count = min(int(header[0]["count"]),
+                        (os.path.getsize(path) - HEADER_SIZE) // TELEMETRY_DTYPE.itemsize)
+            if count == 0:
+                self._segments[index] = np.zeros(0, TELEMETRY_DTYPE)
+            else:
+                self._segments[index] = np.memmap(path, TELEMETRY_DTYPE, "r", offset=HEADER_SIZE, shape=(count,))
+        return self._segments[index]
+
+    def segments(self):
+        """Yields the records of every file, oldest first"""
+        for index in range(len(self.paths)):
+            yield self.segment(index)
+
+    def __len__(self):
+        return sum(len(segment) for segment in self.segments())
+
+    def between(self, start=None, end=None):
+        """Returns a copy of the records written in [start, end), as one array.
+        Only the pages around the bounds are searched, by bisection on the time column,
+        unless the clock went back while the file was written: it is then scanned.
+
+        Arguments:
+            start (float): time.time() of the first record, the beginning by default
+            end (float): time.time() after the last record, the end by default
+        """
+        parts = []
+        for index, segment in enumerate(self.segments()):
+            if not len(segment):
+                continue
+            times = segment["time"]
+            if index in self._unordered:
+                matches = np.ones(len(segment), bool)
+                if start is not None:
+                    matches &= times >= start
+                if end is not None:
+                    matches &= times < end
+                parts.append(np.array(segment[matches]))
+                continue
+            if (end is not None and times[0] >= end) or (start is not None and times[-1] < start):
+                continue
+            first = 0 if start is None else int(np.searchsorted(times, start, "left"))
+            last = len(segment) if end is None else int(np.searchsorted(times, end, "left"))
+            parts.append(np.array(segment[first:last]))
+        return np.concatenate(parts) if parts else np.zeros(0, TELEMETRY_DTYPE)
+
+    def spans(self, condition, start=None, end=None, block=1 << 20):
+        """Returns the (start time, end time, frames) of the runs of consecutive records
+        matching a condition. The logs are scanned by blocks, the memory used doesn't
+        depend on their size.
+
+        Arguments:
+            condition: Function of a block of records returning a boolean array
+            start (float): Only records written from that time
+            end (float): Only records written before that time
+            block (int): Number of records read at once
+        """
+        spans = []
+        current = None   #[start time, end time, frames] of the run still open
+        for segment in self.segments():
+            for offset in range(0, len(segment), block):
+                records = segment[offset:offset + block]
+                matches = np.asarray(condition(records), dtype=bool)
+                if start is not None or end is not None:
+                    times = records["time"]
+                    matches &= (times >= (start if start is not None else -np.inf)) \
+                        & (times < (end if end is not None else np.inf))
+                changes = np.flatnonzero(np.diff(np.concatenate(([0], matches.view(np.int8), [0]))))
+                for run_start, run_stop in zip(changes[::2], changes[1::2]):
+                    run = (float(records["time"][run_start]), float(records["time"][run_stop - 1]),
+                           int(run_stop - run_start))
+                    if current is not None and run_start == 0:
+                        # Continues the run that ended the previous block
+                        current = [current[0], run[1], current[2] + run[2]]
+                    else:
+                        if current is not None:
+                            spans.append(tuple(current))
+                        current = list(run)
+                    if run_stop < len(records):
+                        spans.append(tuple(current))
+                        current = None
+                if current is not None and not matches.any():
+                    spans.append(tuple(current))
+                    current = None
+        if current is not None:
+            spans.append(tuple(current))
+        return spans
+
+    def no_face_spans(self, start=None, end=None):
+        """Returns the (start time, end time, frames) of the periods without a face"""
+        return self.spans(lambda records: ~records["face_found"], start, end)
+
+    def commands(self, command="STOP", start=None, end=None):
+        """Returns a copy of the records where the command changed to the given one
+
+        Arguments:
+            command (str): STOP, CENTER, LEFT or RIGHT
+        """
+        code = COMMANDS.index(command)
+        parts = []
+        for segment in self.segments():
+            for offset in range(0, len(segment), 1 << 20):
+                records = segment[offset:offset + (1 << 20)]
+                matches = (records["command"] == code) & records["changed"]
+                if start is not None:
+                    matches &= records["time"] >= start
+                if end is not None:
+                    matches &= records["time"] < end
+                parts.append(np.array(records[matches]))
+        return np.concatenate(parts) if parts else np.zeros(0, TELEMETRY_DTYPE)
+
+    def summary(self):
+        """Returns the number of records, the time covered and the frame time percentiles"""
+        count = 0
+        first = last = None
+        frame_times = []
+        for segment in self.segments():
+            if not len(segment):
+                continue
+            count += len(segment)
+            first = float(segment["time"][0]) if first is None else first
+            last = float(segment["time"][-1])
+            step = max(len(segment) // 100000, 1)   #Sampled, the percentiles don't need every record
+            frame_times.append(np.array(segment["frame_time"][::step]))
+        summary = {"files": len(self.paths), "records": count, "start": first, "end": last}
+        if frame_times:
+            values = np.concatenate(frame_times) * 1000
+            values = values[~np.isnan(values)]
+            if len(values):
+                summary["frame_time_p50_ms"] = float(np.percentile(values, 50))
+                summary["frame_time_p99_ms"] = float(np.percentile(values, 99))
+        return summary
+
+
+def _parse_time(text):
+    """Returns time.time() for epoch seconds or a local YYYY-MM-DDTHH:MM[:SS] date"""
+    if text is None:
+        return None
+    try:
+        return float(text)
+    except ValueError:
+        pass
+    for layout in ("%Y-%m-%dT%H:%M:%S", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%d %H:%M"):
+        try:
+            return time.mktime(time.strptime(text, layout))
+        except ValueError:
+            continue
+    raise argparse.ArgumentTypeError("can't read the time {}".format(text))
+
+
+def _format_time(value):
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(value)) + "{:.3f}".format(value % 1)[1:]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Query the gaze telemetry logs")
+    parser.add_argument("path", help="log file or directory of log files")
+    parser.add_argument("--from", dest="start", type=_parse_time, help="epoch seconds or YYYY-MM-DDTHH:MM[:SS]")
+    parser.add_argument("--to", dest="end", type=_parse_time, help="epoch seconds or YYYY-MM-DDTHH:MM[:SS]")
+    parser.add_argument("--summary", action="store_true", help="print the size and time span of the logs")
+    parser.add_argument("--no-face", action="store_true", help="print the periods without a face")
+    parser.add_argument("--stops", action="store_true", help="print the frames where STOP was decided")
+    parser.add_argument("-o", "--output", help="save the selected records to this .npy file")
+    args = parser.parse_args(argv)
+
+    reader = TelemetryReader(args.path)
+    if args.summary:
+        summary = reader.summary()
+        print("{files} files, {records} records".format(**summary))
+        if summary["start"] is not None:
+            print("from {} to {}".format(_format_time(summary["start"]), _format_time(summary["end"])))
+        if "frame_time_p50_ms" in summary:
+            print("frame time p50 {frame_time_p50_ms:.2f} ms, p99 {frame_time_p99_ms:.2f} ms".format(**summary))
+    if args.no_face:
+        for start, end, frames in reader.no_face_spans(args.start, args.end):
+            print("no face  {} -> {}  {:.2f} s  {} frames".format(_format_time(start), _format_time(end),
+                                                                  end - start, frames))
+    if args.stops:
+        for record in reader.commands("STOP", args.start, args.end):
+            print("STOP  {}  seq {}  face={} blink={:.2f}".format(_format_time(record["time"]), record["seq"],
+                                                                  bool(record["face_found"]), record["blink_ratio"]))
+    if args.output or not (args.summary or args.no_face or args.stops):
+        records = reader.between(args.start, args.end)
+        if args.output:
+            np.save(args.output, records)
+            print("{} records saved to {}".format(len(records), args.output))
+        else:
+            print("{} records".format(len(records)))
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -2,81 +2,183 @@
 Integration of GazeTracking with Arduino for robot control.
 """
 
+import argparse
 import cv2
-import serial
+import os
 import time
+from gaze_tracking import camera
+from gaze_tracking.sources import CameraSource, ReplayCamera
 from gaze_tracking.gaze_tracking import GazeTracking
+from gaze_tracking.pupil import Pupil
+from gaze_tracking.pipeline import Pipeline
+from gaze_tracking.preview import Preview, FileSink, MjpegSink
+from gaze_tracking.bus import FrameBus
+from gaze_tracking.telemetry import TelemetryLog
+from gaze_tracking.blink import BlinkRecognizer
+from gaze_tracking.command_channel import CommandChannel, LineProtocol, MemoryTransport
+from gaze_tracking.resolution import ResolutionController
+from gaze_tracking.profiles import ProfileStore, camera_key
+
+parser = argparse.ArgumentParser(description="Eye gaze controlled wheelchair")
+parser.add_argument("--replay", metavar="VIDEO", help="play a recorded video instead of using the camera")
+parser.add_argument("--fps", type=float, help="rate of the replayed video, its own by default")
+parser.add_argument("--port", default="COM3", help="serial port of the Arduino")
+parser.add_argument("--fake-serial", action="store_true", help="record the commands in memory instead of sending them")
+parser.add_argument("--headless", action="store_true", help="no window: nothing is copied or drawn unless a preview sink is given")
+parser.add_argument("--preview-rate", type=float, default=10.0, help="maximum preview images per second")
+parser.add_argument("--preview-scale", type=float, default=0.5, help="size of the preview relative to the camera frames")
+parser.add_argument("--preview-file", help="write the preview to this .jpg (last image) or .avi (video)")
+parser.add_argument("--mjpeg-port", type=int, help="serve the preview as MJPEG on http://127.0.0.1:PORT/")
+parser.add_argument("--bus", metavar="NAME", help="publish frames and results to the shared memory bus NAME")
+parser.add_argument("--telemetry", metavar="DIR", default="telemetry", help="directory of the per-frame telemetry log")
+parser.add_argument("--no-telemetry", action="store_true", help="don't write the telemetry log")
+parser.add_argument("--trails", action="store_true", help="print the timings of the last frames at exit")
+args = parser.parse_args()
 
 # Initialize GazeTracking
-gaze = GazeTracking()
-webcam = cv2.VideoCapture(1)
-
-# Set the resolution to 720p
-webcam.set(cv2.CAP_PROP_FRAME_WIDTH, 1280)
-webcam.set(cv2.CAP_PROP_FRAME_HEIGHT, 720)
+# Only detect the face when it is lost, reuse the eyes while they hold still, and recalibrate in the background when the lighting changes
+# People walking behind the wheelchair are detected too, the user is the face that stays where the user was
+# Sub-pixel pupils (Pupil.COMPONENTS) keep the ratios steady when the eye scale drops, for about the same cost per eye as Pupil.CONTOURS
+gaze = GazeTracking(tracking=True, motion_gate=True, pupil_method=Pupil.COMPONENTS, recalibration=True,
+                    multi_face=True, user_selection="tracked")
+gaze.warmup()  # Load the shared models now so the first frame isn't slow
+tracker = ResolutionController(gaze, target_latency=0.05)  # Lowers the analysis resolutions to stay within 50 ms per frame
+
+if args.replay:
+    webcam = ReplayCamera.from_path(args.replay, args.fps)
+    height, width = webcam.frames[0].shape[:2]
+    camera_info = camera.Camera(None, args.replay, "replay", [])
+    mode = (width, height, webcam.fps)
+else:
+    # Use the external camera (index 1) when it is plugged in, in the mode closest to 720p
+    camera_info = camera.select_camera(camera.available_cameras(), preferred_index=1)
+    if camera_info is None:
+        raise SystemExit("No camera found")
+    mode = camera.best_mode(camera_info, 1280, 720) or (1280, 720, 0)
+    webcam = CameraSource(camera_info.index, mode[0], mode[1])
+print(f"Camera {camera_info.index} ({camera_info.name}): {mode[0]}x{mode[1]}")
+
+# Start from the calibration saved for this user and camera, it is checked against the first frames
+user = os.environ.get("GAZE_USER", "default")
+profiles = ProfileStore()
+profile_camera = camera_key(camera_info, mode)
+if not args.replay and profiles.apply(user, profile_camera, gaze.calibration):
+    print(f"Calibration profile loaded for {user} on {profile_camera}")
+profile_saved = bool(args.replay)  # Recorded videos don't update the profiles
 
 # Initialize serial communication with Arduino
-arduino = serial.Serial('COM3', 9600, timeout=1)  # Replace 'COM3' with your Arduino's COM port
-time.sleep(2)  # Allow time for Arduino to reset
-
-# Set frequency to 0.5 seconds (2 Hz)
-frequency = 0.5
-
-# Variables for blink counting and movement control
-blink_count = 0
+if args.fake_serial:
+    arduino = MemoryTransport()
+else:
+    import serial
+    arduino = serial.Serial(args.port, 9600, timeout=1)  # Pass --port with your Arduino's COM port
+    time.sleep(2)  # Allow time for Arduino to reset
+
+# Commands are written in the background, only when they change, plus a heartbeat every 0.5 s.
+# STOP is written when no command was decided for 1 s (analysis stalled, or pupils lost) or when a write fails.
+# LineProtocol keeps the "CENTER\n" text lines, use the default FramedProtocol once the Arduino decodes 4 bytes frames.
+channel = CommandChannel(arduino, protocol=LineProtocol(), heartbeat=0.5, timeout=1.0)
+
+# Every frame's gaze data, command and timings go to a memory-mapped log, read it with `python -m gaze_tracking.telemetry`
+telemetry = None if args.no_telemetry else TelemetryLog(args.telemetry)
+
+# Blink gestures: one blink stops the robot, two or three blinks allow movement
+blinks = BlinkRecognizer()
 movement_allowed = False
 
-while True:
-    start_time = time.time()  # Start time for frequency control
 
-    _, frame = webcam.read()
-    gaze.refresh(frame)
-    frame = gaze.annotated_frame()
-    command = ""
+def decide(gaze, timestamp):
+    """Turns the gaze of the last analyzed frame into a command (runs on the analysis thread)"""
+    global movement_allowed
 
-    # Check for blinking and increment blink count
-    if gaze.is_blinking():
-        if blink_count < 3:  # Allow up to 3 blinks to be counted
-            blink_count += 1
-            print(f"Blink count: {blink_count}")
+    event = blinks.update(gaze.result.blink_ratio, timestamp)
+    if event is not None:
+        print(f"Blink count: {event.count}")
+        movement_allowed = event.count in [2, 3] and not event.long_closure
 
-            time.sleep(0.9)  # Add a short delay to avoid counting the same blink multiple times
-
-    if blink_count == 1:  # Stop robot if blink count is 1 or eyes are shut
-        command = "STOP"
-        movement_allowed = False
-    elif blink_count in [2, 3]:  # Allow movement after two or three blinks
-        movement_allowed = True
-        blink_count = 0  # Reset blink count after movement is allowed
+    # Stop as soon as a blink starts, without waiting to know how many blinks follow
+    if blinks.pending or not movement_allowed:
+        return "STOP"
 
     # Determine movement command based on gaze direction
-    if movement_allowed:
-        if gaze.is_right():
-            command = "RIGHT"  # Turn right
-        elif gaze.is_left():
-            command = "LEFT"  # Turn left
-        elif gaze.is_center():
-            command = "CENTER"  # Move forward
+    if gaze.is_right():
+        return "RIGHT"  # Turn right
+    elif gaze.is_left():
+        return "LEFT"  # Turn left
+    elif gaze.is_center():
+        return "CENTER"  # Move forward
+    return ""
+
+
+def decide_and_log(gaze, timestamp):
+    """Decides the command and appends the frame to the telemetry log (runs on the analysis thread)"""
+    command = decide(gaze, timestamp)
+    telemetry.log_frame(gaze, timestamp, command)
+    return command
+
+
+def send(command):
+    """Queues a command for Arduino (runs on the sender thread)"""
+    channel.send(command)  # The telemetry log records the commands, printing each one would slow the loop down
+
+
+# Capture, analysis and sending run on their own threads, each frame is analyzed as soon as the previous one is done.
+# The analysis thread never draws: the preview renders a downscaled copy of the latest frame on its own thread.
+# With --bus, other processes (recorder, debug UI, logger) read the same frames and results from shared memory
+bus = FrameBus(args.bus) if args.bus else None
+pipeline = Pipeline(webcam, tracker, decide if telemetry is None else decide_and_log, send, annotate=False, bus=bus)
+pipeline.start()
+
+sinks = []
+if args.preview_file:
+    sinks.append(FileSink(args.preview_file, args.preview_rate))
+if args.mjpeg_port:
+    sinks.append(MjpegSink(args.mjpeg_port))
+    print(f"Preview on http://127.0.0.1:{args.mjpeg_port}/")
+preview = None
+if sinks or not args.headless:
+    preview = Preview(pipeline, rate=args.preview_rate, scale=args.preview_scale, sinks=sinks)
+    preview.start()
+
+shown = None
+while pipeline.running:
+    if args.headless:
+        try:
+            time.sleep(0.2)
+        except KeyboardInterrupt:
+            break
     else:
-        command = "STOP"  # If movement is not allowed, stop the robot
-
-    # Send command to Arduino as a string
-    if command:
-        arduino.write((command + "\n").encode('ascii'))  # Send with newline for easier parsing on Arduino
-        print(f"Sent command: {command}")
-
-    # Display the command on the frame
-    cv2.putText(frame, command, (100, 100), cv2.FONT_HERSHEY_DUPLEX, 1.6, (0, 0, 255), 2)
-    cv2.imshow("Demo", frame)
-
-    # Wait to maintain the frequency
-    elapsed_time = time.time() - start_time
-    if elapsed_time < frequency:
-        time.sleep(frequency - elapsed_time)
-
-    if cv2.waitKey(1) == 27:  # Exit on pressing 'Esc'
+        image = preview.image()
+        if image is not None and image is not shown:
+            cv2.imshow("Demo", image)
+            shown = image
+
+    # Save the calibration once it is complete (or checked), for the next session
+    calibration = gaze.calibration
+    if not profile_saved and calibration.is_complete() and not calibration.is_verifying():
+        profiles.save(user, profile_camera, calibration)
+        profile_saved = True
+
+    if not args.headless and cv2.waitKey(max(1, int(1000 / args.preview_rate))) == 27:  # Exit on pressing 'Esc'
         break
 
+pipeline.stop()
+if pipeline.failure is not None:
+    print(f"Stopped after an error: {pipeline.failure!r}")  # STOP was sent, the traceback is in the log
+if preview is not None:
+    preview.stop()
+if bus is not None:
+    bus.close()
+if telemetry is not None:
+    telemetry.close()
+if args.trails:
+    for trail in pipeline.trails()[-10:]:
+        print(trail.as_dict())
+print(tracker.report())
+
 webcam.release()
-cv2.destroyAllWindows()
-arduino.close()
+if not args.headless:
+    cv2.destroyAllWindows()
+channel.close()  # Sends a last STOP
+if not args.fake_serial:
+    arduino.close()